@@ -0,0 +1 @@
+# This package contains the project's custom Scrapy commands.
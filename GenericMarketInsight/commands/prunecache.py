@@ -0,0 +1,22 @@
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.utils.project import data_path
+
+from GenericMarketInsight import httpcache
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[url_regex]"
+
+    def short_desc(self):
+        return "Delete expired HTTP cache entries, and those matching a regex"
+
+    def run(self, args, opts):
+        path = os.path.join(
+            data_path(self.settings['HTTPCACHE_DIR']), 'httpcache.sqlite3')
+        deleted = httpcache.prune(path, args[0] if args else None)
+        print("Deleted {} cache entries from {}".format(deleted, path))
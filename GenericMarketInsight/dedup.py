@@ -0,0 +1,119 @@
+"""Compact sets of already seen URLs."""
+import hashlib
+import math
+import os
+import pickle
+from array import array
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+# Query parameters that never change the page served.
+TRACKING_PARAMS = (
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+    'fbclid', 'gclid', 'ref',
+)
+
+
+def normalize_url(url, strip_params=TRACKING_PARAMS):
+    """Sort the query parameters of `url' and drop `strip_params'."""
+    parsed = list(urlparse(url))
+    parsed[4] = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parsed[4], True)
+        if key not in strip_params))
+    parsed[5] = ''
+    return urlunparse(parsed)
+
+
+def fingerprint(url):
+    """Return a non-zero 64-bit fingerprint of `url'."""
+    digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class FingerprintSet:
+    """Set of 64-bit fingerprints in an open-addressing array.
+
+    Takes 16 to 32 bytes per URL, against the hundred or more of a set of
+    strings. Fingerprint collisions make a URL look seen with a
+    probability of about n / 2**64.
+    """
+
+    def __init__(self, size=1 << 12):
+        self.slots = array('Q', bytes(8 * size))
+        self.mask = size - 1
+        self.count = 0
+
+    def add(self, url):
+        """Add `url', returning whether it was not in the set yet."""
+        value = fingerprint(url)
+        slots, mask = self.slots, self.mask
+        index = value & mask
+        while slots[index]:
+            if slots[index] == value:
+                return False
+            index = (index + 1) & mask
+        slots[index] = value
+        self.count += 1
+        if self.count * 2 > len(slots):
+            self.grow()
+        return True
+
+    def grow(self):
+        values = [value for value in self.slots if value]
+        self.slots = array('Q', bytes(16 * len(self.slots)))
+        self.mask = len(self.slots) - 1
+        for value in values:
+            index = value & self.mask
+            while self.slots[index]:
+                index = (index + 1) & self.mask
+            self.slots[index] = value
+
+    @property
+    def memory(self):
+        return self.slots.itemsize * len(self.slots)
+
+
+class BloomFilter:
+    """Bloom filter sized for `capacity' URLs at `error_rate' false positives.
+
+    Uses a fixed amount of memory, about 1.8 bytes per URL at a 1e-3 error
+    rate, but a false positive makes the spider skip a URL it never saw.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=1e-6):
+        self.nbits = max(8, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def add(self, url):
+        """Add `url', returning whether it was not in the filter yet."""
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        # Kirsch-Mitzenmacher double hashing.
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        new = False
+        for i in range(self.nhashes):
+            bit = (h1 + i * h2) % self.nbits
+            mask = 1 << (bit & 7)
+            if not self.bits[bit >> 3] & mask:
+                self.bits[bit >> 3] |= mask
+                new = True
+        self.count += new
+        return new
+
+    @property
+    def memory(self):
+        return len(self.bits)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save(seen, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(seen, f, protocol=4)
+    os.replace(path + '.tmp', path)
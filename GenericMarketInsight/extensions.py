@@ -0,0 +1,319 @@
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import error, task
+from twisted.web import resource, server
+
+from GenericMarketInsight.signals import stage_timed
+
+logger = logging.getLogger(__name__)
+
+
+class QueueDepthStats:
+    """Sample the scheduler's queue depth every ``QUEUEDEPTH_INTERVAL``
+    seconds.
+
+    Every sample is logged, and the latest number of pending requests in
+    memory and on disk, and the peak of their sum, are kept in the
+    ``scheduler/depth/*`` stats.
+    """
+
+    def __init__(self, crawler, interval):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = interval
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        interval = crawler.settings.getfloat('QUEUEDEPTH_INTERVAL')
+        if not interval:
+            raise NotConfigured
+        o = cls(crawler, interval)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def scheduler(self):
+        engine = self.crawler.engine
+        slot = getattr(engine, 'slot', None) or getattr(engine, '_slot', None)
+        return slot.scheduler if slot is not None else None
+
+    def sample(self, spider):
+        scheduler = self.scheduler()
+        if scheduler is None:
+            return
+
+        memory = len(scheduler.mqs)
+        disk = len(scheduler.dqs) if scheduler.dqs is not None else 0
+        self.stats.set_value('scheduler/depth/memory', memory)
+        self.stats.set_value('scheduler/depth/disk', disk)
+        self.stats.max_value('scheduler/depth/max', memory + disk)
+        logger.info(
+            "Queue depth: %(memory)d requests in memory, %(disk)d on disk",
+            {'memory': memory, 'disk': disk}, extra={'spider': spider})
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.sample, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task and self.task.running:
+            self.task.stop()
+
+
+class Histogram:
+    """Observations counted per bucket, buckets being upper bounds in
+    seconds, like Prometheus histograms."""
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+               2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Return the bucket bound below which a `q' fraction of the
+        observations fall."""
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+        }
+
+
+class MetricsResource(resource.Resource):
+    """Prometheus text exposition of every running `Telemetry'."""
+    isLeaf = True
+
+    def __init__(self):
+        super().__init__()
+        self.telemetries = []
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        lines = []
+        for name, kind, samples in (
+                ('gmi_items_scraped_total', 'counter', lambda t: [
+                    (('', ''), t.items)]),
+                ('gmi_responses_total', 'counter', lambda t: [
+                    (('', ''), t.responses)]),
+                ('gmi_response_bytes_total', 'counter', lambda t: [
+                    (('', ''), t.bytes)]),
+                ('gmi_items_per_second', 'gauge', lambda t: [
+                    (('', ''), t.rate)]),
+                ('gmi_stage_seconds', 'histogram', Telemetry.samples)):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for telemetry in self.telemetries:
+                for (suffix, labels), value in samples(telemetry):
+                    labels = ','.join(
+                        ['spider="{}"'.format(telemetry.spider_name)] +
+                        ([labels] if labels else []))
+                    lines.append('{}{}{{{}}} {}'.format(
+                        name, suffix, labels, value))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class Telemetry:
+    """Where the time of a crawl goes.
+
+    Keeps histograms of the download latency and duration of every
+    callback (through the `middlewares.CallbackTimingMiddleware'), of the
+    pipeline stages and database flushes (through `stage_timed' signals),
+    along with bytes downloaded and items per second. Every
+    ``TELEMETRY_INTERVAL`` seconds a snapshot is appended to
+    ``TELEMETRY_JSONL_PATH``; ``TELEMETRY_PROMETHEUS_PORT`` serves them in
+    the Prometheus text format on ``/metrics``, shared by every spider of
+    the process. A summary is logged when the spider closes.
+    """
+    # Port: (listening port, `MetricsResource'), shared by the crawlers of
+    # a process.
+    servers = {}
+
+    def __init__(self, crawler, interval, jsonl_path=None, port=0,
+                 host='127.0.0.1'):
+        self.crawler = crawler
+        self.interval = interval
+        self.jsonl_path = jsonl_path
+        self.port = port
+        self.host = host
+        self.spider_name = None
+        self.histograms = {}
+        self.items = 0
+        self.responses = 0
+        self.bytes = 0
+        self.rate = 0.0
+        self.started = None
+        self.last_export = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('TELEMETRY_ENABLED'):
+            raise NotConfigured
+        o = cls(
+            crawler,
+            settings.getfloat('TELEMETRY_INTERVAL', 60),
+            settings.get('TELEMETRY_JSONL_PATH'),
+            settings.getint('TELEMETRY_PROMETHEUS_PORT'),
+            settings.get('TELEMETRY_PROMETHEUS_HOST', '127.0.0.1'))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(
+            o.response_received, signal=signals.response_received)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(o.stage_timed, signal=stage_timed)
+        return o
+
+    def observe(self, metric, label, seconds):
+        key = (metric, label)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+
+    def stage_timed(self, metric, label, seconds):
+        self.observe(metric, label, seconds)
+
+    def response_received(self, response, request, spider):
+        self.responses += 1
+        self.bytes += len(response.body)
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.observe('download', getattr(
+                request.callback, '__name__', 'parse'), latency)
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def samples(self):
+        """Yield the ((suffix, labels), value) samples of the stage
+        histograms, in the Prometheus layout."""
+        for (metric, label), histogram in sorted(self.histograms.items()):
+            labels = 'stage="{}",label="{}"'.format(metric, label)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                yield ('_bucket', '{},le="{}"'.format(
+                    labels, '+Inf' if bound == float('inf') else bound)), \
+                    cumulative
+            yield ('_sum', labels), histogram.sum
+            yield ('_count', labels), histogram.count
+
+    def snapshot(self):
+        now = time.time()
+        last_time, last_items = self.last_export
+        if now > last_time:
+            self.rate = (self.items - last_items) / (now - last_time)
+        self.last_export = (now, self.items)
+        return {
+            'time': now,
+            'spider': self.spider_name,
+            'items': self.items,
+            'items_per_sec': round(self.rate, 3),
+            'responses': self.responses,
+            'bytes': self.bytes,
+            'stages': {
+                '{}/{}'.format(metric, label): histogram.summary()
+                for (metric, label), histogram in
+                sorted(self.histograms.items())},
+        }
+
+    def export(self):
+        snapshot = self.snapshot()
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        return snapshot
+
+    def spider_opened(self, spider):
+        self.spider_name = spider.name
+        self.started = time.time()
+        self.last_export = (self.started, 0)
+        if self.jsonl_path:
+            os.makedirs(os.path.dirname(self.jsonl_path) or '.', exist_ok=True)
+        if self.port:
+            self.serve()
+        self.task = task.LoopingCall(self.export)
+        self.task.start(self.interval, now=False)
+
+    def serve(self):
+        from twisted.internet import reactor
+
+        if self.port not in self.servers:
+            metrics = MetricsResource()
+            root = resource.Resource()
+            root.putChild(b'metrics', metrics)
+            try:
+                listening = reactor.listenTCP(
+                    self.port, server.Site(root), interface=self.host)
+            except error.CannotListenError as e:
+                logger.warning("Cannot serve metrics: %s", e)
+                return
+            self.servers[self.port] = (listening, metrics)
+            logger.info("Serving metrics on http://%s:%d/metrics",
+                        self.host, self.port)
+        self.servers[self.port][1].telemetries.append(self)
+
+    def spider_closed(self, spider):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.export()
+
+        if self.port in self.servers:
+            listening, metrics = self.servers[self.port]
+            if self in metrics.telemetries:
+                metrics.telemetries.remove(self)
+            if not metrics.telemetries:
+                del self.servers[self.port]
+                listening.stopListening()
+
+        self.log_summary(spider)
+
+    def log_summary(self, spider):
+        elapsed = time.time() - self.started
+        stats = self.crawler.stats
+        stats.set_value('telemetry/items_per_sec', round(
+            self.items / elapsed if elapsed else 0.0, 3))
+        stats.set_value('telemetry/response_bytes', self.bytes)
+
+        row = '{:<34} {:>8} {:>10} {:>10} {:>10}'
+        lines = [row.format('stage', 'count', 'mean ms', 'p95 ms', 'total s')]
+        for (metric, label), histogram in sorted(self.histograms.items()):
+            name = '{}/{}'.format(metric, label)
+            stats.set_value('telemetry/{}/seconds'.format(name),
+                            round(histogram.sum, 3))
+            lines.append(row.format(
+                name,
+                histogram.count,
+                '{:.2f}'.format(histogram.sum / histogram.count * 1e3),
+                '{:.0f}'.format(histogram.quantile(0.95) * 1e3)
+                if histogram.quantile(0.95) != float('inf') else 'inf',
+                '{:.1f}'.format(histogram.sum)))
+        logger.info(
+            "Telemetry: %(items)d items in %(elapsed).0f s "
+            "(%(rate).2f items/s), %(bytes)d bytes downloaded\n%(table)s", {
+                'items': self.items, 'elapsed': elapsed,
+                'rate': self.items / elapsed if elapsed else 0.0,
+                'bytes': self.bytes, 'table': '\n'.join(lines),
+            }, extra={'spider': spider})
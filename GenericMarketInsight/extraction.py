@@ -0,0 +1,119 @@
+"""Declarative extraction of page fields.
+
+Fields are declared with CSS (parsel's ``::text`` and ``::attr()`` included)
+or XPath, translated and compiled once when the extractor is built, then
+evaluated straight on the lxml tree of every page, without building
+`Selector' objects::
+
+    PRODUCT = Extractor(
+        title=Text('h1::text'),
+        specs=Table('.specs tr', 'td:first-child::text',
+                    'td:last-child::text'),
+    )
+    PRODUCT.extract(response)  # {'title': ..., 'specs': {...}}
+"""
+import abc
+
+from lxml import etree
+from parsel.csstranslator import css2xpath
+
+
+class Field(abc.ABC):
+    def __init__(self, css=None, xpath=None):
+        if (css is None) == (xpath is None):
+            raise ValueError("Pass either css or xpath")
+        self.path = etree.XPath(css2xpath(css) if css is not None else xpath)
+
+    def evaluate(self, node):
+        return self.path(node)
+
+    @abc.abstractmethod
+    def extract(self, node):
+        """Return the value of the field in `node'."""
+
+
+class Text(Field):
+    """The first matching string, or `default' when there is none or it is
+    empty."""
+
+    def __init__(self, css=None, xpath=None, default=None, strip=True):
+        super().__init__(css, xpath)
+        self.default = default
+        self.strip = strip
+
+    def extract(self, node):
+        results = self.evaluate(node)
+        value = str(results[0]) if results else None
+        if not value:
+            value = self.default
+        if value is not None and self.strip:
+            value = value.strip()
+        return value
+
+
+class TextList(Field):
+    """Every matching string."""
+
+    def __init__(self, css=None, xpath=None, strip=False):
+        super().__init__(css, xpath)
+        self.strip = strip
+
+    def extract(self, node):
+        if self.strip:
+            return [str(result).strip() for result in self.evaluate(node)]
+        return [str(result) for result in self.evaluate(node)]
+
+
+class Count(Field):
+    """The number of matching nodes."""
+
+    def extract(self, node):
+        return len(self.evaluate(node))
+
+
+class Exists(Field):
+    """Whether anything matches."""
+
+    def extract(self, node):
+        return bool(self.evaluate(node))
+
+
+class Each(Field):
+    """A dict of `fields', evaluated relative to every matching node."""
+
+    def __init__(self, css=None, xpath=None, **fields):
+        super().__init__(css, xpath)
+        self.fields = fields
+
+    def extract(self, node):
+        return [
+            {name: field.extract(match) for name, field in self.fields.items()}
+            for match in self.evaluate(node)]
+
+
+class Table(Field):
+    """A dict built from the `key' and `value' of every matching row.
+
+    `key' and `value' are CSS queries relative to the row, or fields.
+    """
+
+    def __init__(self, css=None, key=None, value=None, xpath=None):
+        super().__init__(css, xpath)
+        self.key = key if isinstance(key, Field) else Text(key)
+        self.value = value if isinstance(value, Field) else Text(value)
+
+    def extract(self, node):
+        return {
+            self.key.extract(row): self.value.extract(row)
+            for row in self.evaluate(node)}
+
+
+class Extractor:
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def extract(self, response):
+        """Return a dict of every field, extracted from `response'."""
+        root = response.selector.root
+        return {
+            name: field.extract(root) for name, field in self.fields.items()}
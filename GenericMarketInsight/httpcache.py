@@ -0,0 +1,162 @@
+import logging
+import os
+import re
+import sqlite3
+import zlib
+from time import time
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteCacheStorage:
+    """HTTP cache storage keeping compressed responses in one SQLite file.
+
+    Entries are keyed by request fingerprint and shared by every spider and
+    process using the same ``HTTPCACHE_DIR``. ``HTTPCACHE_TTLS`` lists
+    ``(url_regex, seconds)`` pairs; the first pattern matching a URL sets
+    its time to live, ``HTTPCACHE_EXPIRATION_SECS`` applies to the rest and
+    0 means never expire. Bodies are compressed with
+    ``HTTPCACHE_COMPRESSION``, 'zstd' (if installed) or 'zlib'.
+
+    Every spider has its own connection, and each response is committed
+    once stored, so no spider holds the write lock the others wait on.
+    """
+
+    def __init__(self, settings):
+        self.path = os.path.join(
+            data_path(settings['HTTPCACHE_DIR'], createdir=True),
+            'httpcache.sqlite3')
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.ttls = [
+            (re.compile(pattern), int(seconds))
+            for pattern, seconds in settings.getlist('HTTPCACHE_TTLS')]
+        self.codec = settings.get('HTTPCACHE_COMPRESSION', 'zlib')
+        if self.codec == 'zstd' and zstandard is None:
+            logger.warning("zstandard is not installed, using zlib")
+            self.codec = 'zlib'
+        self.db = None
+        self.stats = None
+        self.fingerprint = None
+
+    def open_spider(self, spider):
+        self.db = connect(self.path)
+        self.stats = spider.crawler.stats
+
+        fingerprinter = getattr(spider.crawler, 'request_fingerprinter', None)
+        if fingerprinter:
+            self.fingerprint = lambda r: fingerprinter.fingerprint(r).hex()
+        else:
+            from scrapy.utils.request import request_fingerprint
+            self.fingerprint = request_fingerprint
+
+        logger.debug("Using SQLite cache storage in %(cachepath)s",
+                     {'cachepath': self.path}, extra={'spider': spider})
+
+    def close_spider(self, spider):
+        self.db.close()
+
+    def ttl(self, url):
+        for pattern, seconds in self.ttls:
+            if pattern.search(url):
+                return seconds
+        return self.expiration_secs
+
+    def retrieve_response(self, spider, request):
+        row = self.db.execute(
+            'SELECT url, status, headers, body, codec, expires_at '
+            'FROM responses WHERE fingerprint = ?',
+            (self.fingerprint(request),)).fetchone()
+        if row is None:
+            self.stats.inc_value('httpcache/storage/miss')
+            return None
+
+        url, status, headers, body, codec, expires_at = row
+        if expires_at is not None and expires_at < time():
+            self.stats.inc_value('httpcache/storage/expired')
+            return None
+
+        self.stats.inc_value('httpcache/storage/hit')
+        headers = Headers(headers_raw_to_dict(headers))
+        body = decompress(codec, body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        ttl = self.ttl(response.url)
+        body = compress(self.codec, response.body)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                    self.fingerprint(request),
+                    response.url,
+                    response.status,
+                    headers_dict_to_raw(response.headers),
+                    body,
+                    self.codec,
+                    time() + ttl if ttl > 0 else None,
+                ))
+        self.stats.inc_value('httpcache/storage/bytes_raw', len(response.body))
+        self.stats.inc_value('httpcache/storage/bytes_stored', len(body))
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('PRAGMA journal_mode=WAL')
+    # Commits append to the log, without syncing it to disk.
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS responses ('
+        'fingerprint TEXT PRIMARY KEY, url TEXT, status INTEGER, '
+        'headers BLOB, body BLOB, codec TEXT, expires_at REAL)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS ix_responses_expires_at '
+        'ON responses (expires_at)')
+    db.commit()
+    return db
+
+
+def compress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data)
+    return data
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def prune(path, pattern=None):
+    """Delete expired entries, and those whose URL matches `pattern'.
+
+    Returns the number of entries deleted.
+    """
+    db = connect(path)
+    deleted = db.execute(
+        'DELETE FROM responses WHERE expires_at < ?', (time(),)).rowcount
+    if pattern:
+        regex = re.compile(pattern)
+        db.create_function(
+            'matches', 1, lambda url: regex.search(url) is not None)
+        deleted += db.execute(
+            'DELETE FROM responses WHERE matches(url)').rowcount
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+    return deleted
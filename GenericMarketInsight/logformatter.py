@@ -1,16 +1,71 @@
 import logging
 import os
+import time
 
 from scrapy import logformatter
 
 
 class LogFormatter(logformatter.LogFormatter):
+    """Log dropped items by reason and product ID, counting them per reason
+    in the ``dropped/<reason>`` stats.
+
+    ``DROP_LOG_MODE = 'summary'`` leaves the items out, while ``'verbose'``
+    also dumps them, at most once every ``DROP_LOG_DUMP_INTERVAL`` seconds
+    per reason. Drops of the ``DROP_LOG_QUIET_REASONS``, like products
+    unchanged since they were last scraped, are logged at DEBUG.
+    """
+
+    def __init__(self, stats=None, mode='summary', dump_interval=60,
+                 quiet_reasons=()):
+        self.stats = stats
+        self.verbose = mode == 'verbose'
+        self.dump_interval = dump_interval
+        self.quiet_reasons = set(quiet_reasons)
+        # Reason: time of its last item dump.
+        self.dumped = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        mode = settings.get('DROP_LOG_MODE', 'summary')
+        if mode not in ('summary', 'verbose'):
+            raise ValueError("Unknown DROP_LOG_MODE {!r}".format(mode))
+        return cls(
+            crawler.stats,
+            mode,
+            settings.getfloat('DROP_LOG_DUMP_INTERVAL', 60),
+            settings.getlist('DROP_LOG_QUIET_REASONS'))
+
+    def should_dump(self, reason):
+        if not self.verbose:
+            return False
+        now = time.monotonic()
+        last = self.dumped.get(reason)
+        if last is not None and now - last < self.dump_interval:
+            return False
+        self.dumped[reason] = now
+        return True
+
     def dropped(self, item, exception, response, spider):
+        reason = getattr(exception, 'reason', None) or 'other'
+        product_id = getattr(exception, 'product_id', None)
+        if product_id is None and hasattr(item, 'get'):
+            product_id = item.get('id')
+        if self.stats is not None:
+            self.stats.inc_value('dropped/{}'.format(reason))
+
+        msg = u"Dropped %(product_id)s (%(reason)s): %(exception)s"
+        args = {
+            'reason': reason,
+            'product_id': product_id,
+            'exception': exception,
+        }
+        if self.should_dump(reason):
+            msg += os.linesep + "%(item)s"
+            args['item'] = item
         return {
-            'level': logging.WARNING,
-            'msg': u"Dropped: %(exception)s" + os.linesep + "%(item)s",
-            'args': {
-                'exception': exception,
-                'item': item,
-            }
+            'level': logging.DEBUG if reason in self.quiet_reasons
+            else logging.WARNING,
+            'msg': msg,
+            'args': args,
         }
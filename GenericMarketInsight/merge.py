@@ -0,0 +1,102 @@
+import logging
+
+from sqlalchemy import select
+
+import models
+from GenericMarketInsight.pipelines import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+def merge_database(source_uri, target_uri,
+                   chunk_size=Pipeline.max_query_ids):
+    """Load the crawls stored in `source_uri' into `target_uri'.
+
+    Products go through the same upsert as `Pipeline', so unchanged
+    products are skipped and price observations are appended relative to
+    what the target already holds. Products are read `chunk_size' at a
+    time, and their ids looked up in one ``IN (...)`` clause, so it stays
+    within the variables older SQLite versions allow in a statement.
+    Returns the number of products merged.
+    """
+    source = models.create_db_engine(source_uri)
+    target = models.create_db_engine(target_uri)
+    brands = models.BrandRegistry.for_engine(target)
+    spec_keys = models.SpecKeyRegistry.for_engine(target)
+
+    platforms_table = models.Platform.__table__
+    crawls_table = models.Crawl.__table__
+    products_table = models.Product.__table__
+    brands_table = models.Brand.__table__
+    specs_table = models.Specification.__table__
+    spec_keys_table = models.SpecKey.__table__
+
+    merged = 0
+    with source.connect() as src:
+        platforms = {
+            row.id: models.get_or_create(
+                target, platforms_table, title=row.title, url=row.url)
+            for row in src.execute(platforms_table.select())}
+
+        for crawl in src.execute(crawls_table.select()):
+            with target.begin() as dst:
+                crawl_id = dst.execute(crawls_table.insert().values(
+                    spider=crawl.spider,
+                    platform_id=platforms[crawl.platform_id],
+                    started_at=crawl.started_at,
+                    finished_at=crawl.finished_at,
+                )).inserted_primary_key[0]
+
+            pipeline = Pipeline()
+            pipeline.crawl_id = crawl_id
+
+            # A crawl observes every product it writes, so its observations
+            # tell which products it holds.
+            query = select(products_table, brands_table.c.title.label(
+                'brand_title')).select_from(products_table.outerjoin(
+                    brands_table)).where(products_table.c.id.in_(
+                        select(models.PriceObservation.product_id).where(
+                            models.PriceObservation.crawl_id == crawl.id)))
+            for rows in src.execution_options(stream_results=True). \
+                    execute(query).partitions(chunk_size):
+                products = {}
+                for row in rows:
+                    row = dict(row._mapping)
+                    brand = row.pop('brand_title')
+                    row['platform_id'] = platforms[row['platform_id']]
+                    products[row['id']] = (row, brand)
+
+                specs = {product_id: [] for product_id in products}
+                for spec in src.execute(select(
+                        specs_table.c.product_id, spec_keys_table.c.key,
+                        specs_table.c.value).select_from(
+                            specs_table.join(spec_keys_table)).where(
+                        specs_table.c.product_id.in_(list(products)))):
+                    specs[spec.product_id].append({
+                        'product_id': spec.product_id,
+                        'key': spec.key,
+                        'value': spec.value,
+                    })
+
+                brand_ids = brands.resolve(
+                    target, {brand for _, brand in products.values()})
+                key_ids = spec_keys.resolve(target, {
+                    spec['key'] for rows in specs.values() for spec in rows})
+                with target.begin() as dst:
+                    pipeline.write_products(
+                        dst, products, specs, brand_ids, key_ids)
+                merged += len(products)
+
+        for table in Pipeline.collection_tables:
+            columns = [column for column in table.c if not column.primary_key]
+            for rows in src.execution_options(stream_results=True). \
+                    execute(select(*columns)).partitions(chunk_size):
+                with target.begin() as dst:
+                    dst.execute(
+                        models.insert(dst, table).on_conflict_do_nothing(),
+                        [dict(row._mapping) for row in rows])
+
+    source.dispose()
+    target.dispose()
+    logger.info("Merged %d products from %s", merged, source_uri)
+    return merged
@@ -5,99 +5,481 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import hashlib
+import random
+from time import perf_counter, time
 
+from scrapy import Request, signals
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet.error import TCPTimedOutError, TimeoutError
 
-class GenericmarketinsightSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+from GenericMarketInsight.signals import product_unchanged, \
+    products_stored, stage_timed
+from GenericMarketInsight.state import CrawlState
+
+
+class CallbackTimingMiddleware:
+    """Time every callback, for the `extensions.Telemetry'.
+
+    Sends a `stage_timed' signal per response with the time spent inside
+    the callback's generator, not counting the middlewares and pipelines
+    handling what it yields, so it must be the closest to the spider.
+    """
+
+    def __init__(self, signals):
+        self.signals = signals
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('TELEMETRY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.signals)
+
+    def process_spider_output(self, response, result, spider):
+        callback = getattr(response.request.callback, '__name__', 'parse')
+        elapsed = 0.0
+        results = iter(result)
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    output = next(results)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += perf_counter() - start
+                yield output
+        finally:
+            self.signals.send_catch_log(
+                stage_timed, metric='callback', label=callback,
+                seconds=elapsed)
+
+    async def process_spider_output_async(self, response, result, spider):
+        callback = getattr(response.request.callback, '__name__', 'parse')
+        elapsed = 0.0
+        results = result.__aiter__()
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    output = await results.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += perf_counter() - start
+                yield output
+        finally:
+            self.signals.send_catch_log(
+                stage_timed, metric='callback', label=callback,
+                seconds=elapsed)
+
+
+class CallbackPriorityMiddleware:
+    """Prioritize requests by the callback they are for.
+
+    ``CALLBACK_PRIORITIES`` maps callback names to the priority of the
+    requests yielded for them, so product pages are downloaded before the
+    discovery pages queued with them. Requests given a priority by the
+    spider keep it.
+
+    The ``_async`` and `process_start' variants handle the asynchronous
+    output and start requests of later Scrapy versions; Scrapy 2.1 only
+    calls the others.
+    """
+
+    def __init__(self, priorities):
+        self.priorities = priorities
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        priorities = crawler.settings.getdict('CALLBACK_PRIORITIES')
+        if not priorities:
+            raise NotConfigured
+        return cls(priorities)
+
+    def prioritize(self, result):
+        if isinstance(result, Request) and not result.priority:
+            result.priority = self.priorities.get(
+                getattr(result.callback, '__name__', None), 0)
+        return result
+
+    def process_spider_output(self, response, result, spider):
+        return map(self.prioritize, result)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for output in result:
+            yield self.prioritize(output)
+
+    def process_start_requests(self, start_requests, spider):
+        return map(self.prioritize, start_requests)
+
+    async def process_start(self, start):
+        async for output in start:
+            yield self.prioritize(output)
+
+
+class RevalidationMiddleware:
+    """Revalidate product pages with conditional requests.
+
+    The ETag and Last-Modified validators of every page whose callback is
+    in ``REVALIDATION_CALLBACKS`` are kept in the `CrawlState'. Later
+    requests for the page send them back as If-None-Match and
+    If-Modified-Since; a 304 answer is turned into a `product_unchanged'
+    signal and the request is dropped, so the page is neither parsed nor
+    written again.
+
+    Validators are only kept once the product scraped from the page is in
+    the database, told by a `products_stored' signal, so a product dropped
+    by the pipelines or lost in a crash is downloaded in full next time.
+    """
+
+    def __init__(self, stats, callbacks, state_path):
+        self.stats = stats
+        self.callbacks = set(callbacks)
+        self.state_path = state_path
+        self.state = None
+        self.crawler = None
+        # Product id: (url, etag, last_modified) of the page it was scraped
+        # from, until the product is stored.
+        self.unstored = {}
+        # Ids of the last batch stored. The pipeline holds the item
+        # completing a batch until it is written, so that item is scraped
+        # after the batch is stored.
+        self.stored = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('REVALIDATION_ENABLED'):
+            raise NotConfigured
+        s = cls(
+            crawler.stats,
+            crawler.settings.getlist('REVALIDATION_CALLBACKS'),
+            crawler.settings['CRAWLSTATE_PATH'])
+        s.crawler = crawler
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.products_stored, signal=products_stored)
         return s
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
+    def revalidates(self, request):
+        return getattr(request.callback, '__name__', None) in self.callbacks
 
-        # Should return None or raise an exception.
+    def process_request(self, request, spider):
+        if not self.revalidates(request):
+            return None
+
+        etag, last_modified = self.state.get_validators(request.url)
+        if etag:
+            request.headers.setdefault('If-None-Match', etag)
+        if last_modified:
+            request.headers.setdefault('If-Modified-Since', last_modified)
+        if etag or last_modified:
+            self.stats.inc_value('revalidation/conditional_requests')
         return None
 
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
+    def process_response(self, request, response, spider):
+        if not self.revalidates(request):
+            return response
 
-        # Must return an iterable of Request, dict or Item objects.
-        for i in result:
-            yield i
+        if response.status == 304:
+            self.stats.inc_value('revalidation/not_modified')
+            self.crawler.signals.send_catch_log(
+                product_unchanged, request=request, spider=spider)
+            raise IgnoreRequest("Not modified: {}".format(request.url))
 
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
+        if response.status == 200:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                request.meta['validators'] = (
+                    request.url,
+                    etag.decode('latin-1') if etag else None,
+                    last_modified.decode('latin-1') if last_modified else None)
+        return response
 
-        # Should return either None or an iterable of Request, dict
-        # or Item objects.
-        pass
+    def store_validators(self, url, etag, last_modified):
+        self.state.set_validators(url, etag, last_modified)
+        self.stats.inc_value('revalidation/validators_stored')
 
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
+    def item_scraped(self, item, response, spider):
+        validators = response.meta.get('validators')
+        if validators is None or 'id' not in item:
+            return
+        if item['id'] in self.stored:
+            self.store_validators(*validators)
+        else:
+            self.unstored[item['id']] = validators
 
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
+    def products_stored(self, ids):
+        self.stored = set(ids)
+        for product_id in ids:
+            validators = self.unstored.pop(product_id, None)
+            if validators is not None:
+                self.store_validators(*validators)
 
     def spider_opened(self, spider):
-        spider.logger.info('Spider opened: %s' % spider.name)
+        self.state = CrawlState(self.state_path)
+
+    def spider_closed(self, spider):
+        self.state.close()
+
+
+class CrawlPlannerMiddleware:
+    """Download only the pages that are new or changed since the last crawl.
 
+    For every page whose callback is in ``PLANNER_CALLBACKS`` the
+    `CrawlState' keeps the sitemap <lastmod> it was scheduled with (the
+    request's ``lastmod`` meta key), a hash of its body and when it was
+    crawled. A page is downloaded when it was never crawled, its lastmod
+    changed, or it is older than ``PLANNER_MAX_AGE`` seconds; a random
+    ``PLANNER_REVALIDATE_RATIO`` of the other pages are downloaded anyway
+    to catch changes lastmod does not tell, and the rest are dropped.
+    """
 
-class GenericmarketinsightDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    def __init__(self, stats, callbacks, state_path, revalidate_ratio,
+                 max_age):
+        self.stats = stats
+        self.callbacks = set(callbacks)
+        self.state_path = state_path
+        self.revalidate_ratio = revalidate_ratio
+        self.max_age = max_age
+        self.state = None
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        if not crawler.settings.getbool('PLANNER_ENABLED'):
+            raise NotConfigured
+        s = cls(
+            crawler.stats,
+            crawler.settings.getlist('PLANNER_CALLBACKS'),
+            crawler.settings['CRAWLSTATE_PATH'],
+            crawler.settings.getfloat('PLANNER_REVALIDATE_RATIO'),
+            crawler.settings.getint('PLANNER_MAX_AGE'))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(
+            s.product_unchanged, signal=product_unchanged)
         return s
 
+    def plans(self, request):
+        return getattr(request.callback, '__name__', None) in self.callbacks
+
+    def plan(self, request):
+        """Return why `request' should be downloaded, or None to skip it."""
+        lastmod, _, crawled_at = self.state.get_url(request.url)
+        if crawled_at is None:
+            return 'new'
+        if request.meta.get('lastmod') not in (None, lastmod):
+            return 'changed'
+        if self.max_age and time() - crawled_at > self.max_age:
+            return 'expired'
+        if random.random() < self.revalidate_ratio:
+            return 'revalidated'
+        return None
+
     def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+        if not self.plans(request):
+            return None
+
+        reason = self.plan(request)
+        if reason is None:
+            self.stats.inc_value('planner/skipped')
+            raise IgnoreRequest("Unchanged: {}".format(request.url))
+        self.stats.inc_value('planner/{}'.format(reason))
         return None
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+        if not self.plans(request) or response.status != 200:
+            return response
+
+        lastmod, content_hash, _ = self.state.get_url(request.url)
+        new_hash = hashlib.blake2b(response.body, digest_size=16).hexdigest()
+        if content_hash is not None:
+            self.stats.inc_value('planner/content_{}'.format(
+                'unchanged' if new_hash == content_hash else 'changed'))
+        self.state.set_url(
+            request.url, request.meta.get('lastmod') or lastmod, new_hash,
+            int(time()))
+        return response
+
+    def product_unchanged(self, request, spider):
+        if self.plans(request):
+            self.state.touch_url(request.url, int(time()))
+
+    def spider_opened(self, spider):
+        self.state = CrawlState(self.state_path)
+
+    def spider_closed(self, spider):
+        self.state.close()
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+
+class AdaptiveConcurrencyMiddleware:
+    """Tune every domain's concurrency and delay to what it tolerates.
+
+    Additive increase, multiplicative decrease, per downloader slot: a
+    response under ``ADAPTIVE_TARGET_LATENCY`` seconds raises the slot's
+    concurrency by one per window of requests and shortens its delay by
+    ``ADAPTIVE_DELAY_STEP``; a 429, a 5xx, a timeout or a slower response
+    multiplies the concurrency by ``ADAPTIVE_BACKOFF`` and doubles the
+    delay, at most once per target latency. Limits stay within
+    ``ADAPTIVE_{MIN,MAX}_CONCURRENCY`` and ``ADAPTIVE_{MIN,MAX}_DELAY``
+    and the current ones are kept in the ``adaptive/<slot>/*`` stats.
+    """
+    timeouts = (TimeoutError, TCPTimedOutError)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = settings.getint('ADAPTIVE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint('ADAPTIVE_MAX_CONCURRENCY', 64)
+        self.min_delay = settings.getfloat('ADAPTIVE_MIN_DELAY', 0.0)
+        self.max_delay = settings.getfloat('ADAPTIVE_MAX_DELAY', 30.0)
+        self.delay_step = settings.getfloat('ADAPTIVE_DELAY_STEP', 0.05)
+        self.target_latency = settings.getfloat('ADAPTIVE_TARGET_LATENCY', 2.0)
+        self.backoff = settings.getfloat('ADAPTIVE_BACKOFF', 0.5)
+        # Slot key: [concurrency as a float, time of the last decrease].
+        self.limits = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def slot(self, request):
+        key = request.meta.get('download_slot')
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def congested(self, request, response):
+        # The response is not tied to its request yet, so its meta is not
+        # available.
+        return response.status == 429 or response.status >= 500 or \
+            request.meta.get('download_latency', 0) > self.target_latency
+
+    def process_response(self, request, response, spider):
+        key, slot = self.slot(request)
+        if slot is not None:
+            if self.congested(request, response):
+                self.decrease(key, slot)
+            else:
+                self.increase(key, slot)
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        key, slot = self.slot(request)
+        if slot is not None and isinstance(exception, self.timeouts):
+            self.decrease(key, slot)
+        return None
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def limit(self, key, slot):
+        if key not in self.limits:
+            self.limits[key] = [float(slot.concurrency), 0.0]
+        return self.limits[key]
 
-    def spider_opened(self, spider):
-        spider.logger.info('Spider opened: %s' % spider.name)
+    def increase(self, key, slot):
+        limit = self.limit(key, slot)
+        limit[0] = min(self.max_concurrency, limit[0] + 1 / limit[0])
+        slot.delay = max(self.min_delay, slot.delay - self.delay_step)
+        self.update(key, slot, limit)
+
+    def decrease(self, key, slot):
+        limit = self.limit(key, slot)
+        now = time()
+        if now - limit[1] < self.target_latency:
+            return
+        limit[0] = max(self.min_concurrency, limit[0] * self.backoff)
+        limit[1] = now
+        slot.delay = min(self.max_delay, max(slot.delay * 2, self.delay_step))
+        self.stats.inc_value('adaptive/{}/decreases'.format(key))
+        self.update(key, slot, limit)
+
+    def update(self, key, slot, limit):
+        slot.concurrency = int(limit[0])
+        self.stats.set_value(
+            'adaptive/{}/concurrency'.format(key), slot.concurrency)
+        self.stats.set_value(
+            'adaptive/{}/delay'.format(key), round(slot.delay, 3))
+
+
+class RetryLater(IgnoreRequest):
+    """The request failed and its retry was scheduled for later."""
+
+
+class BackoffRetryMiddleware(RetryMiddleware):
+    """Retry with jittered exponential backoff, within a per domain budget.
+
+    The n-th retry of a request waits a random time up to
+    ``RETRY_BACKOFF_BASE * 2 ** (n - 1)`` seconds, capped at
+    ``RETRY_BACKOFF_MAX``. Once a domain used ``RETRY_ERROR_BUDGET``
+    retries, its failures are given up at once, so an outage costs a
+    bounded number of requests rather than ``RETRY_TIMES`` per page.
+
+    Waiting retries are kept out of the downloader, where they would hold
+    ``CONCURRENT_REQUESTS`` slots every domain shares: the failed request
+    is ignored with `RetryLater' and its retry handed back to the engine
+    once the wait is over. The spider is kept open in the meantime.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1.0)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 60.0)
+        self.error_budget = settings.getint('RETRY_ERROR_BUDGET', 0)
+        self.errors = {}
+        self.stats = None
+        self.crawler = None
+        # Delayed calls of the retries waiting.
+        self.waiting = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler.settings)
+        o.crawler = crawler
+        o.stats = crawler.stats
+        crawler.signals.connect(o.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def reschedule(self, request):
+        self.waiting = {call for call in self.waiting if call.active()}
+        try:
+            self.crawler.engine.crawl(request, self.crawler.spider)
+        except TypeError:
+            # Scrapy 2.10 and later take the request alone.
+            self.crawler.engine.crawl(request)
+
+    def spider_idle(self, spider):
+        if any(call.active() for call in self.waiting):
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        for call in self.waiting:
+            if call.active():
+                call.cancel()
+        self.waiting.clear()
+
+    def _retry(self, request, reason, *args):
+        domain = urlparse_cached(request).hostname
+        errors = self.errors[domain] = self.errors.get(domain, 0) + 1
+        self.stats.set_value('retry/{}/errors'.format(domain), errors)
+        if self.error_budget and errors > self.error_budget:
+            self.stats.inc_value('retry/{}/budget_exhausted'.format(domain))
+            return None
+
+        retry = super()._retry(request, reason, *args)
+        if retry is None:
+            return None
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** (
+            retry.meta['retry_times'] - 1))
+        delay = random.uniform(0, ceiling)
+        if not delay:
+            return retry
+        # The one Scrapy installed, unlike at import time.
+        from twisted.internet import reactor
+        self.waiting.add(reactor.callLater(delay, self.reschedule, retry))
+        self.stats.inc_value('retry/delayed')
+        raise RetryLater("Retrying {} in {:.1f} s".format(request.url, delay))
@@ -5,28 +5,124 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
-
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import Counter
 from urllib.parse import urlparse
 
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.log import failure_to_exc_info
+from sqlalchemy import bindparam, select
+from twisted.internet import defer, task
 
 import models
+from GenericMarketInsight.signals import products_stored, stage_timed
+from GenericMarketInsight.writer import DatabaseWriter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+class DropProduct(DropItem):
+    """`DropItem' telling the `logformatter.LogFormatter' why, by a short
+    `reason' code, and which product was dropped."""
+
+    def __init__(self, reason, product_id, message):
+        super().__init__(message)
+        self.reason = reason
+        self.product_id = product_id
+
+
+# The first number in a price, with thousands separators and decimals, as
+# in "12,500", "12,500.00৳" or "Tk 1,299".
+PRICE_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+# Status: the label items carry.
+STATUS_LABELS = {
+    models.ItemStatusEnum.AVAILABLE: 'Available',
+    models.ItemStatusEnum.OUTOFSTOCK: 'Out Of Stock',
+    models.ItemStatusEnum.DISCONTINUED: 'Discontinued',
+    models.ItemStatusEnum.PREORDER: 'Pre Order',
+    models.ItemStatusEnum.UPCOMING: 'Up Coming',
+    models.ItemStatusEnum.CALLFORPRICE: 'Call for Price',
+}
+STATUSES = {label: status for status, label in STATUS_LABELS.items()}
 
 
 class PreProcessor:
+    """Normalize the items of a platform.
+
+    Prices become the integer value of the first number in them. Statuses
+    are looked up, stripped and lowercased, in `statuses' and replaced by
+    their `STATUS_LABELS'. Prices and statuses that do not parse are
+    counted in `unparseable'; prices become None, statuses are left as
+    they are for the `Pipeline' to drop their item.
+    """
     id_prefix = ''
 
+    # Status text, as is and stripped and lowercased: status.
+    statuses = dict(STATUSES, **{
+        label.lower(): status for label, status in STATUSES.items()})
+    # Status of products whose status text is a price.
+    price_status = None
+    # Status of products without status text.
+    default_status = None
+
     def __init__(self):
-        pass
+        self.unparseable = Counter()
+
+    def parse_price(self, value):
+        if isinstance(value, str):
+            digits = value.replace(',', '')
+            if digits.isdigit():
+                return int(digits)
+            match = PRICE_RE.search(value)
+            if match:
+                return round(float(match.group().replace(',', '')))
+        elif isinstance(value, int):
+            return value
+        self.unparseable['price'] += 1
+        return None
+
+    def parse_status(self, value):
+        """Return the status of `value', or None."""
+        status = self.statuses.get(value)
+        if status is not None:
+            return status
+        if not value or value.isspace():
+            status = self.default_status
+        else:
+            status = self.statuses.get(value.strip().lower())
+            if status is None and self.price_status is not None \
+                    and PRICE_RE.search(value):
+                status = self.price_status
+        if status is None:
+            self.unparseable['status'] += 1
+        return status
 
     def preprocess_product(self, product):
         product['id'] = self.id_prefix + product['id']
-        product['price_regular'] = int(
-            product['price_regular'].replace(',', ''))
-        product['price'] = int(product['price'].replace(',', ''))
-        product['url'] = urlparse(product['url']).path
+        return self.preprocess_update(product)
+
+    def preprocess_update(self, update):
+        """Normalize the prices, status and URL of `update', a product or
+        a grid update."""
+        update['price_regular'] = self.parse_price(update['price_regular'])
+        update['price'] = self.parse_price(update['price'])
+        status = self.parse_status(update.get('status'))
+        if status is not None:
+            update['status'] = STATUS_LABELS[status]
+        update['url'] = urlparse(update['url']).path
 
-        return product
+        return update
 
     def fix_prefix_collection(self, collection, key='product_id'):
         """Prepend `id_prefix' to collection's element's value for `key'"""
@@ -37,61 +133,133 @@ class PreProcessor:
 
 class StarTechPreProcessor(PreProcessor):
     id_prefix = 'stech'
-
-    def __init__(self):
-        super(StarTechPreProcessor, self).__init__()
+    # Products in stock show their price in place of a status.
+    price_status = models.ItemStatusEnum.AVAILABLE
 
     def preprocess_product(self, product):
-        if product['status'].endswith('৳'):
-            product['status'] = 'Available'
         product['code'] = product['id']
         return super().preprocess_product(product)
 
 
 class RyansComputersPreProcessor(PreProcessor):
     id_prefix = 'ryans'
+    statuses = dict(PreProcessor.statuses, **{
+        'in stock': models.ItemStatusEnum.AVAILABLE,
+        'out of stock': models.ItemStatusEnum.OUTOFSTOCK,
+        'stock out': models.ItemStatusEnum.OUTOFSTOCK,
+        'upcoming': models.ItemStatusEnum.UPCOMING,
+        'pre-order': models.ItemStatusEnum.PREORDER,
+    })
+    # Grid cards of products in stock show their price in place of a
+    # status.
+    price_status = models.ItemStatusEnum.AVAILABLE
 
-    def __init__(self):
-        super(RyansComputersPreProcessor, self).__init__()
 
-    def preprocess_product(self, product):
-        product['status'] = 'Available'
-        return super().preprocess_product(product)
+# Spider name: its `PreProcessor'.
+PREPROCESSORS = {
+    'StarTech': StarTechPreProcessor,
+    'RyansComputers': RyansComputersPreProcessor,
+}
 
 
-class Pipeline:
-    db = None
-    ninstances = 0
-    brands = {}
+def digest(values):
+    """Return a short, stable hex digest of `values'."""
+    return hashlib.blake2b(
+        repr(values).encode('utf-8'), digest_size=16).hexdigest()
 
-    def __init__(self):
-        self.item_set = set()
+
+class Pipeline:
+    """Store scraped items through batched Core bulk inserts.
+
+    Rows are buffered and written every ``PIPELINE_BATCH_SIZE`` items or
+    every ``PIPELINE_FLUSH_INTERVAL`` seconds, whichever comes first, so the
+    memory held by the pipeline stays bounded and a crash loses at most
+    one batch. Every database call runs on a `DatabaseWriter' thread; the
+    item completing a batch is held until that batch is written.
+
+    Each instance owns its engine and writer, so spiders run side by side
+    or in separate processes. Brand and specification key ids come from
+    the process-wide `models.BrandRegistry' and `models.SpecKeyRegistry',
+    resolved once per batch.
+
+    Products are upserted. Each flush reads the stored hashes of the
+    buffered products with one query per batch, skips the unchanged ones,
+    and updates only the columns that differ on the rest. A
+    `models.PriceObservation' is appended whenever a product is new or its
+    price or status changed. Once a batch is committed, a `products_stored'
+    signal names its products.
+
+    Grid updates, the price and status a grid shows of the product at a
+    URL, update those columns of the stored product of the platform at
+    that URL, again only when they changed. Those of products not stored
+    yet are left to their product page.
+    """
+    product_columns = (
+        'id', 'title', 'category', 'subcategory1', 'subcategory2',
+        'price_regular', 'price', 'code', 'url', 'status',
+    )
+
+    # Columns an upsert may overwrite on an already stored product.
+    mutable_columns = product_columns[1:] + (
+        'brand_id', 'content_hash', 'specs_hash', 'specs')
+
+    observed_columns = ('price_regular', 'price', 'status')
+    price_columns = ('price_regular', 'price')
+
+    # Rows sharing a foreign key with a buffered product come after it.
+    collection_tables = (
+        models.Review.__table__,
+        models.Question.__table__,
+    )
+
+    # Bound on the number of ids in a single ``IN (...)`` clause.
+    max_query_ids = 500
+
+    def __init__(self, batch_size=500, flush_interval=30, queue_depth=4,
+                 specs_json=False, stats=None, signals=None):
+        self.seen = {}
         self.brand_corrections = {
             'a data': 'ADATA',
             'a4 tech': 'A4TECH',
             'jbl': 'JBL by Harman',
         }
 
+        self.db = None
+        self.brands = None
+        self.spec_keys = None
         self.platform = None
+        self.crawl_id = None
 
         self.preprocessor = None
-        Pipeline.ninstances += 1
-
-    def open_spider(self, spider):
-        if not Pipeline.db:
-            Pipeline.db = models.create_db_session(
-                getattr(spider, 'dburi', models.DEFAULT_DBURI))
 
-        Pipeline.brands = {
-            i.title.lower(): i for i in Pipeline.db.query(models.Brand).all()}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.specs_json = specs_json
+        self.stats = stats
+        self.signals = signals
+        self.writer = DatabaseWriter(queue_depth)
+        self.products = {}
+        self.specs = {}
+        self.collections = {table.name: [] for table in self.collection_tables}
+        self.updates = {}
+        self.buffered_items = 0
+        self.last_flush = time.monotonic()
+        self.flush_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            batch_size=crawler.settings.getint('PIPELINE_BATCH_SIZE', 500),
+            flush_interval=crawler.settings.getfloat(
+                'PIPELINE_FLUSH_INTERVAL', 30),
+            queue_depth=crawler.settings.getint(
+                'PIPELINE_WRITER_QUEUE_DEPTH', 4),
+            specs_json=crawler.settings.getbool('PIPELINE_SPECS_JSON'),
+            stats=crawler.stats,
+            signals=crawler.signals)
 
-        self.item_set = set(
-            i[0] for i in Pipeline.db.query(models.Product.id).all())
-
-        if spider.name == 'RyansComputers':
-            self.preprocessor = RyansComputersPreProcessor()
-        elif spider.name == 'StarTech':
-            self.preprocessor = StarTechPreProcessor()
+    def open_spider(self, spider):
+        self.preprocessor = PREPROCESSORS.get(spider.name, PreProcessor)()
 
         if len(spider.start_urls) > 1:
             spider.log('. '.join([
@@ -99,107 +267,516 @@ class Pipeline:
                 "Have {} URLs",
                 "Picking up the <{}> as the main platform URL"]).format(
                 len(spider.start_urls)), spider.start_urls[0])
-        # Get or set the Platform object.
-        platform_url = urlparse(spider.start_urls[0]).netloc
-        platform_title = spider.platform_title
-
-        self.platform = Pipeline.db.query(models.Platform). \
-            filter(models.Platform.title == platform_title). \
-            filter(models.Platform.url == platform_url).first()
-        if not self.platform:
-            self.platform = models.Platform(title=platform_title, url=platform_url)
-            Pipeline.db.add(self.platform)
-
-    def close_spider(self, _):
-        Pipeline.ninstances -= 1
-        if Pipeline.ninstances == 0:
-            Pipeline.db.commit()
-            Pipeline.db.close()
 
-    def process_collection(self, item, cls):
-        Pipeline.db.add_all([
-            cls(**item) for item in
-            self.preprocessor.fix_prefix_collection(
-                item['collection'])])
+        self.writer.start()
+        d = self.writer.submit(
+            self.open_database,
+            getattr(spider, 'dburi', models.DEFAULT_DBURI),
+            spider.name, spider.platform_title,
+            urlparse(spider.start_urls[0]).netloc)
+        d.addCallback(self.start_flush_task)
+        return d
+
+    def open_database(self, dburi, spider_name, platform_title, platform_url):
+        """Runs on the writer thread."""
+        self.db = models.create_db_engine(dburi)
+        self.brands = models.BrandRegistry.for_engine(self.db)
+        self.spec_keys = models.SpecKeyRegistry.for_engine(self.db)
+
+        # Get or set the Platform row.
+        self.platform = models.get_or_create(
+            self.db, models.Platform.__table__,
+            title=platform_title, url=platform_url)
+
+        with self.db.begin() as conn:
+            self.crawl_id = conn.execute(
+                models.Crawl.__table__.insert().values(
+                    spider=spider_name, platform_id=self.platform,
+                    started_at=int(time.time()))).inserted_primary_key[0]
+
+    def start_flush_task(self, _):
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.timed_flush)
+            self.flush_task.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider=None):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+
+        if self.stats is not None:
+            for field, count in self.preprocessor.unparseable.items():
+                self.stats.set_value(
+                    'preprocess/unparseable/{}'.format(field), count)
+
+        d = self.flush()
+        d.addCallback(lambda _: self.writer.submit(self.close_database))
+        d.addBoth(self.stop_writer)
+        return d
+
+    def close_database(self):
+        """Runs on the writer thread."""
+        crawls = models.Crawl.__table__
+        with self.db.begin() as conn:
+            conn.execute(crawls.update().
+                         where(crawls.c.id == self.crawl_id).
+                         values(finished_at=int(time.time())))
+
+        self.db.dispose()
+
+    def stop_writer(self, result):
+        d = self.writer.stop()
+        d.addCallback(lambda _: result)
+        return d
+
+    def item_buffered(self, item):
+        self.buffered_items += 1
+        if self.buffered_items >= self.batch_size or \
+                time.monotonic() - self.last_flush >= self.flush_interval > 0:
+            return self.flush().addCallback(lambda _: item)
         return item
 
-    def process_item(self, item, _):
-        if 'price_regular' in item:
-            return self.process_product(item)
-        if 'collection' in item:
-            if item['type'] == 'review':
-                return self.process_collection(item, models.Review)
-            if item['type'] == 'question':
-                return self.process_collection(item, models.Question)
+    def timed_flush(self):
+        if time.monotonic() - self.last_flush < self.flush_interval:
+            return None
+        return self.flush().addErrback(
+            lambda failure: logger.error(
+                "Flush failed", exc_info=failure_to_exc_info(failure)))
 
-        raise DropItem("NotImplemented")
+    def flush(self):
+        """Hand the buffered rows to the writer thread.
 
-    def get_set_brand(self, name):
+        Returns a Deferred firing with the number of rows written.
         """
-            Step 1: Check if name is None or not.
-            Step 2: Set name to lower(name), for ease of caching.
-            Step 3: If name is in correction, set name to lower(correct name).
-            Step 4: If name brands is in cache, get the cached Brand object.
-            Step 5: Else, create a Brand object with title = original name
-                    (correct but not lower cased). Then store it into the
-                    cache it with name (correct and lower cased) as the key.
-            Step 6: Return the Brand object.
+        self.last_flush = time.monotonic()
+        if not self.buffered_items:
+            return defer.succeed(0)
+
+        products, specs, collections, updates = \
+            self.products, self.specs, self.collections, self.updates
+        self.products, self.specs, self.updates = {}, {}, {}
+        self.collections = {table.name: [] for table in self.collection_tables}
+        self.buffered_items = 0
+
+        d = self.writer.submit(
+            self.timed_write_batch, products, specs, collections, updates)
+        d.addCallback(self.flushed, list(products))
+        return d
+
+    def flushed(self, result, ids):
+        (written, outcomes), seconds = result
+        self.timed('flush', seconds)
+        total = sum(written.values())
+        if self.stats:
+            for outcome, count in outcomes.items():
+                self.stats.inc_value(
+                    'pipeline/products_{}'.format(outcome), count)
+            for name, count in written.items():
+                self.stats.inc_value(
+                    'pipeline/rows_written/{}'.format(name), count)
+            self.stats.inc_value('pipeline/flushes')
+            self.stats.inc_value('pipeline/rows_written', total)
+            self.stats.set_value('pipeline/last_flush_rows', total)
+        logger.info("Flushed %d rows (%s)", total, ', '.join(
+            '{}={}'.format(name, count) for name, count in written.items()))
+        if self.signals and ids:
+            self.signals.send_catch_log(products_stored, ids=ids)
+        return total
+
+    def timed_write_batch(self, *batch):
+        """Runs on the writer thread.
+
+        Returns what `write_batch' does and the seconds it took, leaving out
+        the time the batch waited for the writer.
         """
-        if not name:
-            return None
+        start = time.perf_counter()
+        result = self.write_batch(*batch)
+        return result, time.perf_counter() - start
+
+    def write_batch(self, products, specs, collections, updates):
+        """Runs on the writer thread, one ``executemany`` per statement.
 
-        name_original = name
-        name = name_original.lower()
-        if name in self.brand_corrections:
-            name_original = self.brand_corrections[name]
-            name = name_original.lower()
+        Returns the rows written per table and the products per outcome.
+        """
+        brand_ids = self.brands.resolve(
+            self.db, {brand for _, brand in products.values()})
+        key_ids = self.spec_keys.resolve(
+            self.db, {spec['key'] for rows in specs.values() for spec in rows})
+
+        with self.db.begin() as conn:
+            written, outcomes = self.write_products(
+                conn, products, specs, brand_ids, key_ids)
+            for table in self.collection_tables:
+                rows = collections[table.name]
+                if rows:
+                    conn.execute(models.insert(
+                        conn, table).on_conflict_do_nothing(), rows)
+                    written[table.name] = len(rows)
+            if updates:
+                urls = {row['url'] for row, _ in products.values()}
+                updated, update_outcomes = self.write_updates(
+                    conn, updates, urls)
+                for name, count in updated.items():
+                    written[name] = written.get(name, 0) + count
+                outcomes.update(update_outcomes)
+        return written, outcomes
+
+    def fetch_stored(self, conn, ids):
+        """Map each stored product id in `ids' to its mutable columns."""
+        products = models.Product.__table__
+        columns = [products.c.id] + [
+            products.c[column] for column in self.mutable_columns]
+        stored = {}
+        for i in range(0, len(ids), self.max_query_ids):
+            for row in conn.execute(select(*columns).where(
+                    products.c.id.in_(ids[i:i + self.max_query_ids]))):
+                stored[row.id] = dict(row._mapping)
+        return stored
+
+    def write_products(self, conn, products, specs, brand_ids, key_ids):
+        """Upsert buffered products, skipping rows whose hashes match.
+
+        `products' maps ids to ``(row, brand)`` pairs, `specs' maps them to
+        their ``{product_id, key, value}`` rows, and `brand_ids' and
+        `key_ids' map brand titles and specification keys to their ids.
+        """
+        outcomes = {'new': 0, 'updated': 0, 'unchanged': 0}
+        if not products:
+            return {}, outcomes
+
+        stored = self.fetch_stored(conn, list(products))
+
+        # Group the rows by the set of columns they change, so every group
+        # is a single upsert statement run through ``executemany``.
+        groups = {}
+        stale_specs = []
+        spec_rows = []
+        observed = []
+        for product_id, (row, brand) in products.items():
+            row['brand_id'] = brand_ids.get(brand)
+
+            current = stored.get(product_id)
+            if current is None:
+                groups.setdefault(self.mutable_columns, []).append(row)
+                spec_rows.extend(specs[product_id])
+                observed.append(row)
+                outcomes['new'] += 1
+                continue
+
+            if current['content_hash'] == row['content_hash'] and \
+                    current['specs_hash'] == row['specs_hash']:
+                outcomes['unchanged'] += 1
+                continue
+
+            changed = tuple(
+                column for column in self.mutable_columns
+                if current[column] != row[column])
+            groups.setdefault(changed, []).append(row)
+            if any(column in changed for column in self.observed_columns):
+                observed.append(row)
+            if current['specs_hash'] != row['specs_hash']:
+                stale_specs.append(product_id)
+                spec_rows.extend(specs[product_id])
+            outcomes['updated'] += 1
+
+        products_table = models.Product.__table__
+        for columns, rows in groups.items():
+            statement = models.insert(conn, products_table)
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=[products_table.c.id],
+                set_={column: statement.excluded[column]
+                      for column in columns}), rows)
+
+        specs_table = models.Specification.__table__
+        for i in range(0, len(stale_specs), self.max_query_ids):
+            conn.execute(specs_table.delete().where(
+                specs_table.c.product_id.in_(
+                    stale_specs[i:i + self.max_query_ids])))
+        if spec_rows:
+            conn.execute(specs_table.insert(), [{
+                'product_id': spec['product_id'],
+                'key_id': key_ids[spec['key']],
+                'value': spec['value'],
+            } for spec in spec_rows])
+
+        observations_table = models.PriceObservation.__table__
+        if observed:
+            timestamp = int(time.time())
+            conn.execute(observations_table.insert(), [{
+                'product_id': row['id'],
+                'crawl_id': self.crawl_id,
+                'timestamp': timestamp,
+                **{column: row[column] for column in self.observed_columns},
+            } for row in observed])
+
+        written = {
+            products_table.name: outcomes['new'] + outcomes['updated'],
+            specs_table.name: len(spec_rows),
+            observations_table.name: len(observed),
+        }
+        return written, outcomes
+
+    def write_updates(self, conn, updates, skipped_urls):
+        """Apply grid `updates', keyed by URL, to the stored products of
+        the platform, recording a `models.PriceObservation' of those that
+        changed. Products at `skipped_urls' are being written from their
+        product page in the same batch. Prices an update lacks, like those
+        of cards showing "Up Coming" instead, keep their stored value.
+        """
+        outcomes = dict.fromkeys(
+            ('grid_changed', 'grid_unchanged', 'grid_unmatched'), 0)
+        products = models.Product.__table__
+        columns = [products.c.id, products.c.url] + [
+            products.c[column] for column in self.observed_columns]
+        urls = [url for url in updates if url not in skipped_urls]
+        stored = {}
+        for i in range(0, len(urls), self.max_query_ids):
+            for row in conn.execute(select(*columns).where(
+                    products.c.platform_id == self.platform,
+                    products.c.url.in_(urls[i:i + self.max_query_ids]))):
+                stored[row.url] = row._mapping
+
+        changed = []
+        for url in urls:
+            update, current = updates[url], stored.get(url)
+            if current is None:
+                outcomes['grid_unmatched'] += 1
+                continue
+            update = dict(update, **{
+                column: current[column] for column in self.price_columns
+                if update[column] is None})
+            if all(current[column] == update[column]
+                   for column in self.observed_columns):
+                outcomes['grid_unchanged'] += 1
+            else:
+                changed.append(dict(update, id=current['id']))
+                outcomes['grid_changed'] += 1
+        if not changed:
+            return {}, outcomes
+
+        # Bound parameters cannot share the name of the columns they set.
+        # The stored content hash no longer matches the row, so it is
+        # cleared for the next product page to be written whatever it shows.
+        conn.execute(products.update().where(
+            products.c.id == bindparam('product_id')).values(dict({
+                column: bindparam('new_' + column)
+                for column in self.observed_columns}, content_hash=None)), [
+            dict({'new_' + column: row[column]
+                  for column in self.observed_columns}, product_id=row['id'])
+            for row in changed])
+
+        observations = models.PriceObservation.__table__
+        timestamp = int(time.time())
+        conn.execute(observations.insert(), [{
+            'product_id': row['id'],
+            'crawl_id': self.crawl_id,
+            'timestamp': timestamp,
+            **{column: row[column] for column in self.observed_columns},
+        } for row in changed])
+        return {products.name: len(changed),
+                observations.name: len(changed)}, outcomes
 
-        if name in Pipeline.brands:
-            return Pipeline.brands[name]
+    def process_collection(self, item, cls):
+        self.collections[cls.__tablename__].extend(
+            self.preprocessor.fix_prefix_collection(item['collection']))
+        return self.item_buffered(item)
+
+    def timed(self, stage, seconds):
+        if self.signals:
+            self.signals.send_catch_log(
+                stage_timed, metric='pipeline', label=stage, seconds=seconds)
+
+    def process_item(self, item, spider=None):
+        start = time.perf_counter()
+        try:
+            if item.get('type') == 'grid_update':
+                return self.process_update(item)
+            if 'price_regular' in item:
+                return self.process_product(item)
+            if 'collection' in item:
+                if item['type'] == 'review':
+                    return self.process_collection(item, models.Review)
+                if item['type'] == 'question':
+                    return self.process_collection(item, models.Question)
+
+            raise DropProduct(
+                'not_implemented', item.get('id'), "NotImplemented")
+        finally:
+            self.timed(
+                'process_' + item.get('type', 'product'),
+                time.perf_counter() - start)
+
+    def correct_brand(self, name):
+        """Return the corrected title of brand `name', or None."""
+        if not name:
+            return None
 
-        brand = models.Brand(title=name_original)
+        return self.brand_corrections.get(name.lower(), name)
 
-        Pipeline.brands[name] = brand
-        Pipeline.db.add(brand)
+    def process_update(self, item):
+        item = self.preprocessor.preprocess_update(item)
+        status = STATUSES.get(item['status'])
+        if status is None:
+            raise DropProduct(
+                'unknown_status', item['url'],
+                "Unknown status {}".format(item['status']))
 
-        return brand
+        self.updates[item['url']] = {
+            'price_regular': item['price_regular'],
+            'price': item['price'],
+            'status': status,
+        }
+        return self.item_buffered(item)
 
     def process_product(self, item):
         item = self.preprocessor.preprocess_product(item)
 
-        if item['id'] in self.item_set:
-            raise DropItem("Duplicate product")
-
-        self.item_set.add(item['id'])
-
-        db_item = item.copy()
-
-        status = db_item['status']
-        if status == 'Available':
-            db_item['status'] = models.ItemStatusEnum.AVAILABLE
-        elif status == "Out Of Stock":
-            db_item['status'] = models.ItemStatusEnum.OUTOFSTOCK
-        elif status == "Discontinued":
-            db_item['status'] = models.ItemStatusEnum.DISCONTINUED
-        elif status == "Pre Order":
-            db_item['status'] = models.ItemStatusEnum.PREORDER
-        elif status == "Up Coming":
-            db_item['status'] = models.ItemStatusEnum.UPCOMING
-        elif status == "Call for Price":
-            db_item['status'] = models.ItemStatusEnum.CALLFORPRICE
-        else:
-            # TODO: modify logger's dropped method to be more user friendly.
-            raise DropItem("Item {} has unknown status {}".format(db_item['id'], status))
+        db_item = {column: item.get(column) for column in self.product_columns}
 
-        db_item['brand'] = self.get_set_brand(item['brand'])
+        status = STATUSES.get(db_item['status'])
+        if status is None:
+            raise DropProduct(
+                'unknown_status', db_item['id'],
+                "Unknown status {}".format(db_item['status']))
+        db_item['status'] = status
 
-        db_item['platform'] = self.platform
+        brand = self.correct_brand(item['brand'])
 
-        db_item['specifications'] = [
-            models.Specification(key=spec[0], value=spec[1])
-            for spec in item['specifications'].items()
+        db_item['platform_id'] = self.platform
+
+        db_item['content_hash'] = digest(tuple(
+            db_item[column] for column in self.product_columns[1:]
+        ) + ((brand or '').lower(),))
+        db_item['specs_hash'] = digest(sorted(item['specifications'].items()))
+        db_item['specs'] = item['specifications'] if self.specs_json else None
+
+        hashes = (db_item['content_hash'], db_item['specs_hash'])
+        if self.seen.get(item['id']) == hashes:
+            raise DropProduct('duplicate', item['id'], "Duplicate product")
+        self.seen[item['id']] = hashes
+
+        self.products[item['id']] = (db_item, brand)
+        # Rows without a key cannot be interned, nor queried.
+        self.specs[item['id']] = [
+            {'product_id': item['id'], 'key': spec[0], 'value': spec[1]}
+            for spec in item['specifications'].items() if spec[0]
         ]
 
-        Pipeline.db.add(models.Product(**db_item))
+        return self.item_buffered(item)
+
+
+class ParquetExportPipeline:
+    """Write scraped items to Parquet files, for columnar analytics.
+
+    Placed after `Pipeline', it gets normalized items: prefixed ids, integer
+    prices and duplicates dropped. Every table goes to its own dataset
+    under ``PARQUET_EXPORT_DIR``, partitioned by platform (the spider) and
+    crawl (its start time, UTC)::
+
+        <dir>/products/platform=StarTech/crawl=20200521T100000/part-0.parquet
+
+    Rows are buffered and written one ``PARQUET_ROW_GROUP_SIZE`` row group
+    at a time, so memory stays bounded. Read the datasets with
+    ``pyarrow.dataset.dataset(path, partitioning='hive')``, or DuckDB and
+    pandas alike. Needs pyarrow.
+    """
+    columns = {
+        'products': (
+            ('id', 'string'), ('title', 'string'), ('category', 'string'),
+            ('subcategory1', 'string'), ('subcategory2', 'string'),
+            ('brand', 'string'), ('price_regular', 'int64'),
+            ('price', 'int64'), ('code', 'string'), ('url', 'string'),
+            ('status', 'string'), ('scraped_at', 'int64'),
+        ),
+        'specifications': (
+            ('product_id', 'string'), ('key', 'string'), ('value', 'string'),
+        ),
+        'reviews': (
+            ('product_id', 'string'), ('username', 'string'),
+            ('rating', 'int64'), ('comment', 'string'),
+        ),
+        'questions': (
+            ('product_id', 'string'), ('username', 'string'),
+            ('question', 'string'), ('answer', 'string'),
+        ),
+    }
+
+    def __init__(self, directory, row_group_size=10000, compression='snappy'):
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.schemas = {
+            table: pyarrow.schema([
+                (name, getattr(pyarrow, type_)()) for name, type_ in columns])
+            for table, columns in self.columns.items()}
+        self.partition = None
+        self.writers = {}
+        self.rows = {table: [] for table in self.columns}
+        self.stats = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        directory = crawler.settings.get('PARQUET_EXPORT_DIR')
+        if not directory:
+            raise NotConfigured
+        if pyarrow is None:
+            logger.warning(
+                "pyarrow is not installed, not exporting to Parquet")
+            raise NotConfigured
+        o = cls(
+            directory,
+            crawler.settings.getint('PARQUET_ROW_GROUP_SIZE', 10000),
+            crawler.settings.get('PARQUET_COMPRESSION', 'snappy'))
+        o.stats = crawler.stats
+        return o
 
+    def open_spider(self, spider):
+        self.partition = os.path.join(
+            'platform={}'.format(spider.name),
+            'crawl={}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime())),
+            'part-{}.parquet'.format(getattr(spider, 'shard', 0)))
+
+    def close_spider(self, spider):
+        for table in self.schemas:
+            self.write(table)
+        for writer in self.writers.values():
+            writer.close()
+
+    def writer(self, table):
+        if table not in self.writers:
+            path = os.path.join(self.directory, table, self.partition)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.writers[table] = pyarrow.parquet.ParquetWriter(
+                path, self.schemas[table], compression=self.compression)
+        return self.writers[table]
+
+    def write(self, table):
+        rows = self.rows[table]
+        if not rows:
+            return
+
+        schema = self.schemas[table]
+        batch = pyarrow.Table.from_pydict(
+            {name: [row.get(name) for row in rows] for name in schema.names},
+            schema=schema)
+        self.writer(table).write_table(batch)
+        self.stats.inc_value('parquet/rows/{}'.format(table), len(rows))
+        self.rows[table] = []
+
+    def add(self, table, rows):
+        self.rows[table].extend(rows)
+        if len(self.rows[table]) >= self.row_group_size:
+            self.write(table)
+
+    def process_item(self, item, spider=None):
+        if item.get('type') == 'grid_update':
+            return item
+        if 'price_regular' in item:
+            self.add('products', [dict(item, scraped_at=int(time.time()))])
+            self.add('specifications', [
+                {'product_id': item['id'], 'key': key, 'value': value}
+                for key, value in item['specifications'].items()])
+        elif item.get('type') == 'review':
+            self.add('reviews', item['collection'])
+        elif item.get('type') == 'question':
+            self.add('questions', item['collection'])
         return item
@@ -0,0 +1,161 @@
+"""Statistical profiler for whole crawls.
+
+A ``SIGPROF`` timer interrupts the process every `interval' seconds of CPU
+time, and the handler records the Python stack of every thread busy at that
+moment, so a crawl pays for a few dozen stack walks a second whatever it
+does. Samples are written as collapsed stacks, one ``frame;frame;... count``
+line per distinct stack, the input of ``flamegraph.pl`` and speedscope, and
+summed per project module for a table of where the time goes::
+
+    profiler = SamplingProfiler()
+    profiler.start()
+    process.start()
+    profiler.stop()
+    profiler.write_collapsed('datadir/crawl.collapsed')
+    print(profiler.format_table())
+
+Unix only, and `start' must be called from the main thread.
+"""
+import os
+import signal
+import sys
+import threading
+from collections import Counter
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Innermost frames of threads waiting rather than working: the reactor
+# polling and pool threads waiting for work.
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('epollreactor.py', 'doPoll'),
+    ('pollreactor.py', 'doPoll'),
+    ('selectreactor.py', 'doSelect'),
+    ('kqreactor.py', 'doKEvent'),
+}
+
+OTHER = '(other)'
+
+
+def module_name(filename):
+    """Return the dotted name of the project module at `filename', or None
+    when it is not part of the project."""
+    path = os.path.abspath(filename)
+    if not path.startswith(PROJECT_ROOT + os.sep) \
+            or os.sep + 'site-packages' + os.sep in path:
+        return None
+    return os.path.splitext(os.path.relpath(path, PROJECT_ROOT))[0].replace(
+        os.sep, '.')
+
+
+def frame_label(code):
+    module = module_name(code.co_filename)
+    if module is None:
+        module = os.path.basename(code.co_filename)
+    return '{}:{}'.format(module, code.co_name)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        # Stack of code objects, outermost first: samples.
+        self.stacks = Counter()
+        self.idle = 0
+        self.previous_handler = None
+        # Frames of the main thread up to the caller of `start', left out of
+        # the samples as they only lead to the code profiled.
+        self.depth = 0
+
+    def start(self):
+        self.depth = 0
+        frame = sys._getframe(1)
+        while frame is not None:
+            self.depth += 1
+            frame = frame.f_back
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        main = threading.main_thread().ident
+        frames = sys._current_frames()
+        # Skip the handler's own frame, on top of the main thread's stack.
+        frames[main] = frame
+        for ident, frame in frames.items():
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in \
+                    IDLE_FRAMES:
+                self.idle += 1
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            if ident == main:
+                stack = stack[self.depth:]
+            self.stacks[tuple(stack)] += 1
+
+    @property
+    def samples(self):
+        return sum(self.stacks.values())
+
+    def collapsed(self):
+        """Return the samples as collapsed stack lines."""
+        labels = {}
+        merged = Counter()
+        for stack, count in self.stacks.items():
+            for code in stack:
+                if code not in labels:
+                    labels[code] = frame_label(code)
+            merged[';'.join(labels[code] for code in stack)] += count
+        return ['{} {}'.format(stack, count)
+                for stack, count in sorted(merged.items())]
+
+    def write_collapsed(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+
+    def by_module(self):
+        """Return {module: [self samples, total samples]} of the project
+        modules.
+
+        A sample counts as the self time of the innermost project module on
+        its stack, so the time spent in Scrapy, lxml or SQLAlchemy on behalf
+        of a pipeline is the pipeline's. Stacks without project code count
+        towards `OTHER'. Total samples are those with the module anywhere
+        on the stack.
+        """
+        modules = {}
+        for stack, count in self.stacks.items():
+            names = [module_name(code.co_filename) for code in stack]
+            innermost = next(
+                (name for name in reversed(names) if name), OTHER)
+            modules.setdefault(innermost, [0, 0])[0] += count
+            for name in set(names) | {innermost}:
+                if name:
+                    modules.setdefault(name, [0, 0])[1] += count
+        return modules
+
+    def format_table(self, top=20):
+        samples = self.samples
+        lines = ['{} samples of {:g} ms, {} idle'.format(
+            samples, self.interval * 1e3, self.idle)]
+        if not samples:
+            return lines[0]
+        row = '{:<48} {:>8} {:>8}'
+        lines.append(row.format('module', 'self %', 'total %'))
+        modules = sorted(self.by_module().items(),
+                         key=lambda item: item[1][0], reverse=True)
+        for name, (own, total) in modules[:top]:
+            lines.append(row.format(
+                name,
+                '{:.1f}'.format(own * 100 / samples),
+                '{:.1f}'.format(total * 100 / samples)))
+        return '\n'.join(lines)
@@ -15,6 +15,7 @@ BOT_NAME = 'GenericMarketInsight'
 
 SPIDER_MODULES = ['GenericMarketInsight.spiders']
 NEWSPIDER_MODULE = 'GenericMarketInsight.spiders'
+COMMANDS_MODULE = 'GenericMarketInsight.commands'
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:76.0) Gecko/20100101 Firefox/76.0'
@@ -29,9 +30,11 @@ CONCURRENT_REQUESTS = 128
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 DOWNLOAD_DELAY = 0.25
-# The download delay setting will honor only one of:
-# CONCURRENT_REQUESTS_PER_DOMAIN = 16
-CONCURRENT_REQUESTS_PER_IP = 32
+# Starting point of every domain's concurrency, tuned at run time by the
+# AdaptiveConcurrencyMiddleware. The download delay applies per domain, as
+# CONCURRENT_REQUESTS_PER_IP is not set.
+CONCURRENT_REQUESTS_PER_DOMAIN = 32
+# CONCURRENT_REQUESTS_PER_IP = 32
 
 # Disable cookies (enabled by default)
 # COOKIES_ENABLED = False
@@ -47,31 +50,115 @@ CONCURRENT_REQUESTS_PER_IP = 32
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    'GenericMarketInsight.middlewares.MarketscraperSpiderMiddleware': 543,
-# }
+SPIDER_MIDDLEWARES = {
+    'GenericMarketInsight.middlewares.CallbackPriorityMiddleware': 543,
+    'GenericMarketInsight.middlewares.CallbackTimingMiddleware': 1000,
+}
+
+# Priority of the requests for every callback: products first, then the
+# pages leading to them, reviews and questions last.
+CALLBACK_PRIORITIES = {
+    'parse_product': 100,
+    'parse_sitemap_location': 50,
+    'parse_grid': 10,
+    'parse_product_reviews': -50,
+    'parse_product_question': -50,
+}
+
+# Pending requests are kept on disk, in a JOBDIR per spider and shard under
+# JOBS_DIR (see run.py), so the queue of a full crawl does not fill memory.
+# Set JOBS_DIR to None to keep them in memory.
+JOBS_DIR = 'datadir/jobs'
+SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleLifoDiskQueue'
+SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.LifoMemoryQueue'
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'GenericMarketInsight.middlewares.MarketscraperDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # Closer to the downloader than the HTTP cache (900), so cached
+    # responses are never revalidated and 304s are never cached.
+    'GenericMarketInsight.middlewares.RevalidationMiddleware': 950,
+    # Before the HTTP cache, so skipped pages are not even looked up.
+    'GenericMarketInsight.middlewares.CrawlPlannerMiddleware': 850,
+    'GenericMarketInsight.middlewares.AdaptiveConcurrencyMiddleware': 980,
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    'GenericMarketInsight.middlewares.BackoffRetryMiddleware': 550,
+}
+
+# Per domain AIMD control of concurrency and delay, see
+# GenericMarketInsight.middlewares.AdaptiveConcurrencyMiddleware.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 64
+ADAPTIVE_MIN_DELAY = 0.0
+ADAPTIVE_MAX_DELAY = 30.0
+ADAPTIVE_DELAY_STEP = 0.05
+ADAPTIVE_TARGET_LATENCY = 2.0
+ADAPTIVE_BACKOFF = 0.5
+
+# Send If-None-Match/If-Modified-Since for pages parsed by these callbacks.
+REVALIDATION_ENABLED = True
+REVALIDATION_CALLBACKS = ['parse_product']
+
+# What previous crawls learnt about URLs.
+CRAWLSTATE_PATH = 'datadir/crawlstate.sqlite3'
+
+# Collect reviews and questions, off for price only runs. Star Tech's are
+# only requested when their count on the product page changed.
+COLLECT_FEEDBACK = True
+
+# Incremental crawls: only download pages new or changed since the last one,
+# plus a random sample of the rest.
+PLANNER_ENABLED = False
+PLANNER_CALLBACKS = ['parse_product', 'parse_sitemap_location']
+PLANNER_REVALIDATE_RATIO = 0.05
+PLANNER_MAX_AGE = 7 * 24 * 60 * 60
+
+# Take Ryans Computers' prices and statuses from the grids, fetching product
+# pages only of new products and those not fetched for PRODUCT_PAGE_MAX_AGE
+# seconds. Off in the workers of ``run.py --workers``, whose staging
+# databases have no stored products to update.
+GRID_UPDATES_ENABLED = True
+PRODUCT_PAGE_MAX_AGE = 7 * 24 * 60 * 60
 
 RETRY_ENABLED = True
 RETRY_TIMES = 10
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
+# Retries allowed per domain and crawl, 0 for no limit.
+RETRY_ERROR_BUDGET = 500
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+EXTENSIONS = {
+    'GenericMarketInsight.extensions.QueueDepthStats': 500,
+    'GenericMarketInsight.extensions.Telemetry': 500,
+}
+
+# Seconds between samples of the scheduler's queue depth, 0 to disable.
+QUEUEDEPTH_INTERVAL = 60
+
+# Callback, download and pipeline timings, see `extensions.Telemetry'.
+TELEMETRY_ENABLED = True
+TELEMETRY_INTERVAL = 60
+TELEMETRY_JSONL_PATH = 'datadir/telemetry.jsonl'
+# Serve them to Prometheus on http://<host>:<port>/metrics, 0 to disable.
+TELEMETRY_PROMETHEUS_PORT = 0
+TELEMETRY_PROMETHEUS_HOST = '127.0.0.1'
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     'GenericMarketInsight.pipelines.Pipeline': 300,
+    'GenericMarketInsight.pipelines.ParquetExportPipeline': 400,
 }
 
+# Also export items to Parquet datasets under this directory, if set and
+# pyarrow is installed.
+PARQUET_EXPORT_DIR = None
+PARQUET_ROW_GROUP_SIZE = 10000
+PARQUET_COMPRESSION = 'snappy'
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
@@ -88,12 +175,53 @@ ITEM_PIPELINES = {
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 HTTPCACHE_ENABLED = True
-HTTPCACHE_EXPIRATION_SECS = 0
+# Product and grid pages expire after a day, see HTTPCACHE_TTLS for others.
+HTTPCACHE_EXPIRATION_SECS = 24 * 60 * 60
 HTTPCACHE_DIR = 'httpcache'
 HTTPCACHE_IGNORE_HTTP_CODES = []
-HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.DbmCacheStorage'
+HTTPCACHE_STORAGE = 'GenericMarketInsight.httpcache.SqliteCacheStorage'
+# (url_regex, seconds) pairs, the first match wins; 0 never expires.
+# Expired entries are deleted with `scrapy prunecache`.
+HTTPCACHE_TTLS = [
+    (r'/brand/', 0),
+    (r'sitemap', 6 * 60 * 60),
+]
+# 'zlib', or 'zstd' if the zstandard package is installed.
+HTTPCACHE_COMPRESSION = 'zlib'
 
 DUPEFILTER_CLASS = 'scrapy.dupefilters.BaseDupeFilter'
 
+# Spiders deduplicate the URLs they follow themselves, see
+# utils.UniqueFollowMixin. DEDUP_STRUCTURE is 'fingerprints' (exact up to
+# 64-bit hash collisions) or 'bloom' (fixed memory, DEDUP_ERROR_RATE false
+# positives over DEDUP_CAPACITY URLs).
+DEDUP_STRUCTURE = 'fingerprints'
+DEDUP_CAPACITY = 1000000
+DEDUP_ERROR_RATE = 1e-6
+# Sort query parameters and strip DEDUP_STRIP_PARAMS before deduplicating.
+DEDUP_NORMALIZE = True
+DEDUP_STRIP_PARAMS = [
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+    'fbclid', 'gclid', 'ref',
+]
+# Set to a directory to remember followed URLs between runs, e.g. together
+# with JOBDIR to resume an interrupted crawl.
+DEDUP_PERSIST_DIR = None
+
 LOG_LEVEL = logging.INFO
 LOG_FORMATTER = 'GenericMarketInsight.logformatter.LogFormatter'
+# Log dropped items by reason and ID ('summary'), or also dump the items
+# ('verbose'), at most once every DROP_LOG_DUMP_INTERVAL seconds per reason.
+DROP_LOG_MODE = 'summary'
+DROP_LOG_DUMP_INTERVAL = 60
+# Reasons logged at DEBUG, being expected on every recrawl.
+DROP_LOG_QUIET_REASONS = ['duplicate']
+
+# Items are written to the database in batches, flushed every
+# PIPELINE_BATCH_SIZE items or PIPELINE_FLUSH_INTERVAL seconds.
+PIPELINE_BATCH_SIZE = 500
+PIPELINE_FLUSH_INTERVAL = 30
+# Batches waiting for or being written by the database writer thread.
+PIPELINE_WRITER_QUEUE_DEPTH = 4
+# Also store every product's specifications as one JSON column.
+PIPELINE_SPECS_JSON = False
@@ -0,0 +1,13 @@
+"""Signals sent by the project, in addition to Scrapy's own."""
+
+# Sent with `request' and `spider' when a product page is known not to have
+# changed since the previous crawl, instead of reaching its callback.
+product_unchanged = object()
+
+# Sent with `ids' once a batch with the products of those ids is committed
+# to the database, whether they were written or found unchanged.
+products_stored = object()
+
+# Sent with `metric', `label' and `seconds' when a timed stage of the crawl,
+# like a pipeline flush, completes.
+stage_timed = object()
@@ -1,34 +1,164 @@
 # -*- coding: utf-8 -*-
 import logging
+import time
 from urllib.parse import urlparse, urljoin
 
 import scrapy
+from scrapy import signals
+from w3lib.url import safe_url_string
 
-from GenericMarketInsight.utils import remove_puncts, update_url_query, \
-    extract_locations, UniqueFollowMixin
+from GenericMarketInsight.extraction import Count, Each, Exists, Extractor, \
+    Table, Text
+from GenericMarketInsight.signals import product_unchanged, \
+    products_stored
+from GenericMarketInsight.state import CrawlState
+from GenericMarketInsight.utils import update_url_query, \
+    iter_sitemap, PrefixTrie, UniqueFollowMixin
 
 
 def update_limit_qs(link, limit=72):
     return update_url_query(link, {'limit': limit})
 
 
+PRODUCT_PAGE = Extractor(
+    missing=Exists('h3 > i'),
+    product_id=Text('input[name=product_id]::attr(value)', strip=False),
+    title=Text('.produc-details-short .title::text'),
+    price=Text('.produc-details-short .price::text', default='0'),
+    price_regular=Text('.produc-details-short .old-price::text', default='0'),
+    code=Text('.produc-details-short p > span::text'),
+    reviews=Each(
+        '.comments',
+        rating=Count('.fa-star'),
+        username=Text('p > span::text'),
+        comment=Text('p:last-child::text', default=''),
+    ),
+    # Only the first information table holds specifications.
+    specifications=Table(
+        xpath="(descendant-or-self::*[contains(concat(' ', "
+              "normalize-space(@class), ' '), ' information ')])[1]"
+              "/descendant-or-self::tr",
+        key='td:first-child::text',
+        value='td:last-child::text',
+    ),
+)
+
+
+GRID_PAGE = Extractor(
+    cards=Each(
+        '.product-box',
+        url=Text('.product-title-grid::attr(href)'),
+        title=Text('.product-title-grid::text'),
+        logo=Text('.product-logo img::attr(src)'),
+        price=Text('.product-price-grid .price::text'),
+        price_regular=Text('.product-price-grid .old-price::text'),
+    ),
+)
+
+
 class RyanscomputersSpider(scrapy.Spider, UniqueFollowMixin):
     name = 'RyansComputers'
-    platform_title = 'Star Tech'
+    platform_title = 'Ryans Computers'
     allowed_domains = ['ryanscomputers.com', 'www.ryanscomputers.com']
     start_urls = ['https://ryanscomputers.com']
 
-    def __init__(self):
-        super(RyanscomputersSpider, self).__init__()
+    def __init__(self, *args, **kwargs):
+        super(RyanscomputersSpider, self).__init__(*args, **kwargs)
         self.brand_cache = {}
         self.brand_cache_completion = 0
         self.brands = set()
+        self.brand_trie = PrefixTrie()
+        self._crawl_state = None
+        # Product id: (URL, time) its page was fetched, until the product
+        # is stored.
+        self.unstored = {}
+        # Ids of the last batch stored, which the item completing it is
+        # scraped after.
+        self.stored = set()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(RyanscomputersSpider, cls).from_crawler(
+            crawler, *args, **kwargs)
+        crawler.signals.connect(
+            spider.product_unchanged, signal=product_unchanged)
+        crawler.signals.connect(
+            spider.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(
+            spider.products_stored, signal=products_stored)
+        return spider
+
+    @property
+    def crawl_state(self):
+        if self._crawl_state is None:
+            self._crawl_state = CrawlState(self.settings['CRAWLSTATE_PATH'])
+        return self._crawl_state
+
+    def closed(self, reason):
+        super(RyanscomputersSpider, self).closed(reason)
+        if self._crawl_state is not None:
+            self._crawl_state.close()
+
+    def product_page_due(self, url):
+        """Whether the product page at `url' should be fetched: it never
+        was, or not for ``PRODUCT_PAGE_MAX_AGE`` seconds."""
+        fetched_at = self.crawl_state.get_product_fetched(url)
+        max_age = self.settings.getint(
+            'PRODUCT_PAGE_MAX_AGE', 7 * 24 * 60 * 60)
+        return fetched_at is None or time.time() - fetched_at > max_age
+
+    @staticmethod
+    def page_url(request):
+        """Return the URL the grid linked to, before any redirect."""
+        return request.meta.get('redirect_urls', [request.url])[0]
+
+    def product_unchanged(self, request, spider):
+        """A product page not modified since it was stored counts as
+        fetched, like one parsed again."""
+        if request.callback == self.parse_product:
+            self.crawl_state.set_product_fetched(
+                self.page_url(request), int(time.time()))
+
+    def item_scraped(self, item, response, spider):
+        """Keep when the page of a product was fetched until the product
+        is stored, so one dropped or lost is fetched again next time."""
+        if 'id' not in item or response.request.callback != \
+                self.parse_product:
+            return
+        fetched = (self.page_url(response.request), int(time.time()))
+        if item['id'] in self.stored:
+            self.crawl_state.set_product_fetched(*fetched)
+        else:
+            self.unstored[item['id']] = fetched
+
+    def products_stored(self, ids):
+        self.stored = set(ids)
+        for product_id in ids:
+            fetched = self.unstored.pop(product_id, None)
+            if fetched is not None:
+                self.crawl_state.set_product_fetched(*fetched)
+
+    @staticmethod
+    def product_url(response, href):
+        """Return the URL `follow_once' requests for a product's `href'.
+
+        Grid updates and product pages both key their product by it, so
+        they meet in the database whatever redirects the page goes through.
+        `follow_once' lowercases what it is given, so the percent escapes of
+        non-ASCII characters are lowercased here too.
+        """
+        return safe_url_string(response.urljoin(href.lower().strip())).lower()
+
+    def add_brand(self, brand):
+        if brand not in self.brands:
+            self.brands.add(brand)
+            self.brand_trie.add(brand)
 
     def parse_and_populate_brand_cache(self, response, brand):
         self.brand_cache[response.css(
             '.product-logo img::attr(src)').get()] = brand
         self.brand_cache_completion -= 1
-        self.brands.add(brand)
+        self.add_brand(brand)
         if self.brand_cache_completion == 0:
             yield response.follow(self.start_urls[0], self.parse_main)
             yield response.follow(
@@ -37,8 +167,14 @@ class RyanscomputersSpider(scrapy.Spider, UniqueFollowMixin):
         # TODO: Parse  products sitemap.
 
     def parse_category_sitemap(self, response):
-        for location in extract_locations(response.body):
-            yield self.follow_once(response, location, self.parse_grid)
+        for entry in iter_sitemap(response.body):
+            if entry.is_index:
+                yield self.follow_once(
+                    response, entry.loc, self.parse_category_sitemap)
+            elif self.in_shard(entry.loc):
+                yield self.follow_once(
+                    response, entry.loc, self.parse_grid,
+                    meta={'lastmod': entry.lastmod})
 
     def parse(self, response):
         # Populate url-brand dictionary.
@@ -75,7 +211,8 @@ class RyanscomputersSpider(scrapy.Spider, UniqueFollowMixin):
                 path = urlparse(link).path
                 if link == "javascript:void(0);" or \
                         not path.startswith('/grid') or \
-                        path.startswith('/grid/all-'):
+                        path.startswith('/grid/all-') or \
+                        not self.in_shard(link):
                     continue
 
                 yield self.follow_once(
@@ -91,10 +228,9 @@ class RyanscomputersSpider(scrapy.Spider, UniqueFollowMixin):
                 )
 
     def match_brand(self, title):
-        for brand_filter in self.brands:
-            if remove_puncts(title.lower()).startswith(
-                    remove_puncts(brand_filter.lower())):
-                return brand_filter
+        brand = self.brand_trie.longest_prefix(title)
+        if brand:
+            return brand
         self.log("NO BRANDS FOR {}".format(title), logging.WARNING)
         return None
 
@@ -127,14 +263,33 @@ class RyanscomputersSpider(scrapy.Spider, UniqueFollowMixin):
             if brand.strip() not in self.brands]
 
         for brand in brand_filters:
-            self.brands.add(brand)
+            self.add_brand(brand)
 
         brand_filters.extend(self.brand_cache.values())
 
-        for box in response.css(".product-box"):
-            product_url = box.css('.product-title-grid::attr(href)').get()
-            cache_hit = self.brand_cache.get(
-                box.css('.product-logo img::attr(src)').get())
+        grid_updates = self.settings.getbool('GRID_UPDATES_ENABLED')
+        for card in GRID_PAGE.extract(response)['cards']:
+            if not card['url']:
+                continue
+            product_url = self.product_url(response, card['url'])
+            # Cards of products not in stock show their status in place of
+            # the price.
+            status = card['price']
+            if grid_updates:
+                # Cards show what price tracking needs, the product page is
+                # only fetched for the rest.
+                yield {
+                    'type': 'grid_update',
+                    'url': product_url,
+                    'price': card['price'],
+                    'price_regular': card['price_regular'] or card['price'],
+                    'status': status,
+                }
+                if not self.product_page_due(product_url):
+                    self.crawler.stats.inc_value('grid/product_pages_skipped')
+                    continue
+
+            cache_hit = self.brand_cache.get(card['logo'])
             yield self.follow_once(
                 response,
                 product_url,
@@ -142,46 +297,41 @@ class RyanscomputersSpider(scrapy.Spider, UniqueFollowMixin):
                 cb_kwargs={
                     'category': category,
                     'brand': cache_hit if cache_hit else self.match_brand(
-                        box.css('.product-title-grid::text').get()),
+                        card['title']),
+                    'status': status,
                 })
 
-    def parse_product(self, response, category, brand):
-        if response.css('h3 > i'):
+    def parse_product(self, response, category, brand, status=None):
+        page = PRODUCT_PAGE.extract(response)
+        if page['missing']:
             self.log("PRODUCT DOES NOT EXIST <{}>".format(
                 response.request.url), logging.WARNING)
             return
 
-        details = response.css('.produc-details-short')
-        product_id = response.css('input[name=product_id]::attr(value)').get()
+        url = self.page_url(response.request)
 
-        # XXX: This site does not have pagination for product reviews.
-        yield {
-            'type': 'review',
-            'collection': [{
-                'product_id': product_id,
-                'rating': len(comment.css('.fa-star')),
-                'username': comment.css('p > span::text').get().strip(),
-                'comment': (comment.css(
-                    'p:last-child::text').get() or '').strip(),
-            } for comment in response.css('.comments')]
-        }
+        product_id = page['product_id']
 
-        specs = {}
-        for tr in response.css('.information')[0].css('tr'):
-            specs[tr.css('td:first-child::text').get().strip()] = \
-                tr.css('td:last-child::text').get().strip()
+        # XXX: This site does not have pagination for product reviews.
+        if self.settings.getbool('COLLECT_FEEDBACK', True):
+            yield {
+                'type': 'review',
+                'collection': [
+                    dict(review, product_id=product_id)
+                    for review in page['reviews']],
+            }
 
         yield {
             'id': product_id,
-            'title': details.css(".title::text").get().strip(),
+            'title': page['title'],
             'category': category[0],
             'subcategory1': category[1],
             'subcategory2': category[2],
             'brand': brand,
-            'price': (details.css('.price::text').get() or '0').strip(),
-            'price_regular': (details.css(
-                '.old-price::text').get() or '0').strip(),
-            'specifications': specs,
-            'code': details.css("p > span::text").get().strip(),
-            'url': response.request.url,
+            'price': page['price'],
+            'price_regular': page['price_regular'],
+            'specifications': page['specifications'],
+            'code': page['code'],
+            'status': status,
+            'url': url,
         }
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import logging
+import re
 from urllib.parse import urljoin
 
 import scrapy
 
-from GenericMarketInsight.utils import update_url_query, extract_locations, \
+from GenericMarketInsight.extraction import Count, Each, Extractor, Table, \
+    Text, TextList
+from GenericMarketInsight.state import CrawlState
+from GenericMarketInsight.utils import update_url_query, iter_sitemap, \
     UniqueFollowMixin
 
 
@@ -12,6 +16,52 @@ def update_limit_qs(link, limit=90):
     return update_url_query(link, {'limit': limit})
 
 
+COUNT_RE = re.compile(r'\((\d+)\)')
+
+
+def heading_count(heading):
+    """Return N of a 'Reviews (N) :' like heading, or None."""
+    match = COUNT_RE.search(heading or '')
+    return int(match.group(1)) if match else None
+
+
+PRODUCT_PAGE = Extractor(
+    product_id=Text('.product-code::text', strip=False),
+    reviews_heading=Text('#write-review > h3::text', strip=False),
+    questions_heading=Text('#ask-question > h3::text', strip=False),
+    title=Text('h1.product-name::text', strip=False),
+    breadcrumbs=TextList('ul.breadcrumb span::text'),
+    specifications=Table(
+        '.data-table tbody tr',
+        key='td:first-child::text',
+        value='td:last-child::text',
+    ),
+    price=Text('.product-price::text', default='', strip=False),
+    price_offer=Text('.product-price ins ::text', default='', strip=False),
+    price_regular=Text('.product-regular-price::text', strip=False),
+    brand=Text('.product-brand::text', strip=False),
+    status=Text('div.price-wrap > ins::text', strip=False),
+)
+
+REVIEWS_PAGE = Extractor(
+    reviews=Each(
+        '.review-wrap',
+        rating=Count('.fa-star'),
+        username=Text('h6.answerer::text'),
+        comment=Text('p.answer::text', default=''),
+    ),
+)
+
+QUESTIONS_PAGE = Extractor(
+    questions=Each(
+        '.question-wrap',
+        username=Text('h5.question::text'),
+        question=Text('h6.questioner::text', default=''),
+        answer=Text('p.answer::text', default=''),
+    ),
+)
+
+
 class StartechSpider(scrapy.Spider, UniqueFollowMixin):
     # NOTE: Star Tech's sitemap is unmaintained,
     # hence scrapy.Spider is inherited.
@@ -21,9 +71,36 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
     allowed_domains = ['www.startech.com.bd']
     start_urls = ['https://www.startech.com.bd/']
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
         self.product_ids = set()
-        super(StartechSpider, self).__init__()
+        self._crawl_state = None
+        super(StartechSpider, self).__init__(*args, **kwargs)
+
+    @property
+    def crawl_state(self):
+        if self._crawl_state is None:
+            self._crawl_state = CrawlState(self.settings['CRAWLSTATE_PATH'])
+        return self._crawl_state
+
+    def closed(self, reason):
+        super(StartechSpider, self).closed(reason)
+        if self._crawl_state is not None:
+            self._crawl_state.close()
+
+    def follow_feedback(self, response, kind, count, url, callback,
+                        product_id):
+        """Request the reviews or questions (`kind') of a product, unless
+        there are none or as many as were collected last time."""
+        if count == 0 or (count is not None and count ==
+                          self.crawl_state.get_feedback_count(
+                              product_id, kind)):
+            self.crawler.stats.inc_value('feedback/{}/skipped'.format(kind))
+            return None
+        return response.follow(
+            url % product_id, callback, cb_kwargs={
+                'product_id': product_id,
+                'count': count,
+            })
 
     def parse_sitemap_location(self, response):
         if response.css('div.price-wrap > ins'):
@@ -33,20 +110,25 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
 
     def parse_sitemap(self, response):
         self.log("Evaluating sitemap", logging.INFO)
-        for location in extract_locations(response.body):
-            yield self.follow_once(
-                response, location,
-                self.parse_sitemap_location)
+        for entry in iter_sitemap(response.body):
+            if entry.is_index:
+                yield self.follow_once(response, entry.loc, self.parse_sitemap)
+            elif self.in_shard(entry.loc):
+                yield self.follow_once(
+                    response, entry.loc,
+                    self.parse_sitemap_location,
+                    meta={'lastmod': entry.lastmod})
 
     def parse(self, response):
         if getattr(self, 'noincremental', 'yes').lower() in \
                 ['yes', 'y', 't', 'true']:
             self.log("Crawling behaviour enabled.", logging.INFO)
-            self.visited.add(response.request.url)
+            self.mark_visited(response.request.url)
             for anchor in response.css(' '.join(
                     ['ul.responsive-menu',
                      'a:not([class=see-all])::attr(href)'])).extract():
-                yield self.follow_once(response, anchor, self.parse_grid)
+                if self.in_shard(anchor):
+                    yield self.follow_once(response, anchor, self.parse_grid)
             yield response.follow('/sitemap.xml', self.parse_sitemap)
         else:
             self.log(
@@ -56,9 +138,10 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
             upto = getattr(self, 'id_limit', 13020)
             base_url = urljoin(
                 self.start_urls[0], 'product/product') + '?product_id='
-            for i in range(start, upto):
-                yield response.follow(
-                    base_url + str(i), self.parse_product)
+            for i in range(int(start), int(upto)):
+                if self.in_shard(str(i)):
+                    yield response.follow(
+                        base_url + str(i), self.parse_product)
 
     def parse_grid(self, response):
         for anchor in response.css('h4.product-name a::attr(href)').extract():
@@ -70,17 +153,15 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
             yield self.follow_once(
                 response, next_page, self.parse_grid)
 
-    def parse_product_question(self, response, product_id):
+    def parse_product_question(self, response, product_id, count=None):
+        if count is not None:
+            self.crawl_state.set_feedback_count(product_id, 'question', count)
+
         yield {
             'type': 'question',
-            'collection': [{
-                'product_id': product_id,
-                'username': question.css('h5.question::text').get().strip(),
-                'question': (
-                        question.css('h6.questioner::text').get() or '').strip(),
-                'answer': (
-                        question.css('p.answer::text').get() or '').strip(),
-            } for question in response.css('.question-wrap')]
+            'collection': [
+                dict(question, product_id=product_id)
+                for question in QUESTIONS_PAGE.extract(response)['questions']],
         }
 
         yield from response.follow_all(
@@ -90,15 +171,15 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
                 'product_id': product_id,
             })
 
-    def parse_product_reviews(self, response, product_id):
+    def parse_product_reviews(self, response, product_id, count=None):
+        if count is not None:
+            self.crawl_state.set_feedback_count(product_id, 'review', count)
+
         yield {
             'type': 'review',
-            'collection': [{
-                'product_id': product_id,
-                'rating': len(comment.css('.fa-star')),
-                'username': comment.css('h6.answerer::text').get().strip(),
-                'comment': (comment.css('p.answer::text').get() or '').strip(),
-            } for comment in response.css('.review-wrap')]
+            'collection': [
+                dict(review, product_id=product_id)
+                for review in REVIEWS_PAGE.extract(response)['reviews']],
         }
 
         yield from response.follow_all(
@@ -109,26 +190,26 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
             })
 
     def parse_product(self, response):
-        product_id = response.css('.product-code::text').get()
+        page = PRODUCT_PAGE.extract(response)
+        product_id = page['product_id']
         if product_id in self.product_ids:
             return
         self.product_ids.add(product_id)
 
-        if response.css('#write-review > h3::text') != 'Reviews (0) :':
-            yield response.follow(
-                '/product/product/review?product_id=%s' % product_id,
-                self.parse_product_reviews, cb_kwargs={
-                    'product_id': product_id,
-                })
-        yield response.follow(
-            '/product/product/question?product_id=%s' % product_id,
-            self.parse_product_question, cb_kwargs={
-                'product_id': product_id,
-            })
-
-        title = response.css('h1.product-name::text').get()
+        if self.settings.getbool('COLLECT_FEEDBACK', True):
+            yield self.follow_feedback(
+                response, 'review', heading_count(page['reviews_heading']),
+                '/product/product/review?product_id=%s',
+                self.parse_product_reviews, product_id)
+            yield self.follow_feedback(
+                response, 'question',
+                heading_count(page['questions_heading']),
+                '/product/product/question?product_id=%s',
+                self.parse_product_question, product_id)
+
+        title = page['title']
         categoricals = [None, None, None]
-        breadcrumbs = response.css('ul.breadcrumb span::text').extract()[:-1]
+        breadcrumbs = page['breadcrumbs'][:-1]
         for i, crumb in enumerate(breadcrumbs):
             if i >= len(categoricals):
                 if breadcrumbs[i].lower() != breadcrumbs[i - 1].lower():
@@ -137,15 +218,10 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
                 break
             categoricals[i] = crumb.strip()
 
-        specs = {}
-        for table_row in response.css('.data-table tbody tr'):
-            specs[table_row.css('td:first-child::text').get().strip()] = \
-                table_row.css('td:last-child::text').get().strip()
-
-        price = response.css('.product-price::text').get()[:-1]
+        price = page['price'][:-1]
         if not price.strip():
-            price = response.css('.product-price ins ::text').get()[:-1]
-        price_regular = response.css('.product-regular-price::text').get()
+            price = page['price_offer'][:-1]
+        price_regular = page['price_regular']
         if price_regular:
             price_regular = price_regular[:-1]
         else:
@@ -157,10 +233,10 @@ class StartechSpider(scrapy.Spider, UniqueFollowMixin):
             'category': categoricals[0],
             'subcategory1': categoricals[1],
             'subcategory2': categoricals[2],
-            'brand': response.css('.product-brand::text').get(),
+            'brand': page['brand'],
             'price_regular': price_regular,
             'price': price,
-            'specifications': specs,
-            'status': response.css('div.price-wrap > ins::text').get(),
+            'specifications': page['specifications'],
+            'status': page['status'],
             'url': response.request.url,
         }
@@ -0,0 +1,93 @@
+import sqlite3
+
+
+class CrawlState:
+    """What previous crawls learnt about URLs, kept in a SQLite file.
+
+    Shared by the spiders and middlewares needing to remember something
+    between runs, each through its own connection to the same file. Every
+    write is committed at once, so none of them holds the write lock the
+    others wait on; with WAL and ``synchronous=NORMAL`` a commit is an
+    append to the log, not a sync to disk.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS validators ('
+        'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)',
+        'CREATE TABLE IF NOT EXISTS urls ('
+        'url TEXT PRIMARY KEY, lastmod TEXT, content_hash TEXT, '
+        'crawled_at INTEGER)',
+        'CREATE TABLE IF NOT EXISTS feedback_counts ('
+        'product_id TEXT, kind TEXT, count INTEGER, '
+        'PRIMARY KEY (product_id, kind))',
+        'CREATE TABLE IF NOT EXISTS product_pages ('
+        'url TEXT PRIMARY KEY, fetched_at INTEGER)',
+    )
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.schema:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def write(self, statement, parameters):
+        with self.db:
+            self.db.execute(statement, parameters)
+
+    def close(self):
+        self.db.close()
+
+    def get_validators(self, url):
+        """Return the (etag, last_modified) pair stored for `url'."""
+        return self.db.execute(
+            'SELECT etag, last_modified FROM validators WHERE url = ?',
+            (url,)).fetchone() or (None, None)
+
+    def set_validators(self, url, etag, last_modified):
+        self.write(
+            'INSERT OR REPLACE INTO validators VALUES (?, ?, ?)',
+            (url, etag, last_modified))
+
+    def get_url(self, url):
+        """Return the (lastmod, content_hash, crawled_at) stored for `url'."""
+        return self.db.execute(
+            'SELECT lastmod, content_hash, crawled_at FROM urls WHERE url = ?',
+            (url,)).fetchone() or (None, None, None)
+
+    def set_url(self, url, lastmod, content_hash, crawled_at):
+        self.write(
+            'INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+            (url, lastmod, content_hash, crawled_at))
+
+    def touch_url(self, url, crawled_at):
+        """Record `url' as crawled at `crawled_at', its content unchanged."""
+        self.write(
+            'UPDATE urls SET crawled_at = ? WHERE url = ?', (crawled_at, url))
+
+    def get_feedback_count(self, product_id, kind):
+        """Return how many reviews or questions (`kind') of the product
+        were collected last, or None."""
+        row = self.db.execute(
+            'SELECT count FROM feedback_counts '
+            'WHERE product_id = ? AND kind = ?', (product_id, kind)).fetchone()
+        return row[0] if row else None
+
+    def set_feedback_count(self, product_id, kind, count):
+        self.write(
+            'INSERT OR REPLACE INTO feedback_counts VALUES (?, ?, ?)',
+            (product_id, kind, count))
+
+    def get_product_fetched(self, url):
+        """Return when the product page at `url' was last fetched, or
+        None."""
+        row = self.db.execute(
+            'SELECT fetched_at FROM product_pages WHERE url = ?',
+            (url,)).fetchone()
+        return row[0] if row else None
+
+    def set_product_fetched(self, url, fetched_at):
+        self.write(
+            'INSERT OR REPLACE INTO product_pages VALUES (?, ?)',
+            (url, fetched_at))
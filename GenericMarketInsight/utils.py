@@ -1,8 +1,15 @@
+import gzip
+import os
 import string
+import zlib
+from collections import namedtuple
+from io import BytesIO
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
 from lxml import etree
 
+from GenericMarketInsight import dedup
+
 
 def update_url_query(url, query):
     parsed = list(urlparse(url))
@@ -13,23 +20,151 @@ def update_url_query(url, query):
     return urlunparse(parsed)
 
 
+SitemapEntry = namedtuple('SitemapEntry', ('loc', 'lastmod', 'is_index'))
+
+
+def iter_sitemap(body):
+    """Yield a `SitemapEntry' for every <url> of a sitemap, or every
+    <sitemap> of a sitemap index, as it is parsed.
+
+    Elements are freed once read, so memory does not grow with the length
+    of the sitemap. Gzipped bodies (``.xml.gz``) are decompressed on the
+    fly; `lastmod' is the raw W3C datetime, or None.
+    """
+    stream = BytesIO(body)
+    if body[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+
+    for _, element in etree.iterparse(
+            stream, tag=('{*}url', '{*}sitemap'), resolve_entities=False):
+        loc = lastmod = None
+        for child in element:
+            name = child.tag[child.tag.rfind('}') + 1:]
+            if name == 'loc':
+                loc = child.text
+            elif name == 'lastmod':
+                lastmod = child.text
+        if loc and loc.strip():
+            yield SitemapEntry(
+                loc.strip(),
+                lastmod.strip() if lastmod else None,
+                element.tag.endswith('sitemap'))
+
+        # Free the entry and the already read ones before it.
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
 def extract_locations(xml):
-    et = etree.fromstring(xml)
-    for location in et.xpath(
-            './n:url/n:loc/text()', namespaces={'n': et.nsmap[None]}):
-        yield location
+    for entry in iter_sitemap(xml):
+        if not entry.is_index:
+            yield entry.loc
 
 
 def remove_puncts(text):
     return ''.join([' ' if c in string.punctuation else c for c in text])
 
 
+class PrefixTrie:
+    """Find which of a growing set of words prefixes a text, in one pass
+    over the text.
+
+    Words and texts are compared lower cased, punctuation being read as
+    spaces, like `remove_puncts'. The longest matching word wins.
+    """
+    end = ''
+    table = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
+    def __init__(self, words=()):
+        self.root = {}
+        for word in words:
+            self.add(word)
+
+    def normalize(self, text):
+        return text.lower().translate(self.table)
+
+    def add(self, word):
+        node = self.root
+        for char in self.normalize(word):
+            node = node.setdefault(char, {})
+        node.setdefault(self.end, word)
+
+    def longest_prefix(self, text):
+        """Return the longest added word prefixing `text', or None."""
+        node, match = self.root, None
+        for char in self.normalize(text):
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(self.end, match)
+        return match
+
+
 class UniqueFollowMixin:
-    visited = set()
+    """Follow every URL at most once per spider.
+
+    Seen URLs are kept in a `dedup.FingerprintSet', or a `dedup.BloomFilter'
+    when ``DEDUP_STRUCTURE`` is 'bloom'. ``DEDUP_NORMALIZE`` sorts query
+    parameters and strips ``DEDUP_STRIP_PARAMS`` before a URL is looked up,
+    and ``DEDUP_PERSIST_DIR`` keeps the seen URLs between runs.
+    """
+    _seen = None
+
+    @property
+    def seen(self):
+        if self._seen is None:
+            self._seen = self.load_seen()
+        return self._seen
+
+    def dedup_path(self):
+        directory = self.settings.get('DEDUP_PERSIST_DIR')
+        if directory:
+            return os.path.join(directory, '{}.seen'.format(self.name))
+        return None
+
+    def load_seen(self):
+        path = self.dedup_path()
+        if path and os.path.exists(path):
+            return dedup.load(path)
+        if self.settings.get('DEDUP_STRUCTURE') == 'bloom':
+            return dedup.BloomFilter(
+                self.settings.getint('DEDUP_CAPACITY', 1000000),
+                self.settings.getfloat('DEDUP_ERROR_RATE', 1e-6))
+        return dedup.FingerprintSet()
+
+    def mark_visited(self, url):
+        """Record `url' as followed, returning whether it was new."""
+        url = url.lower().strip()
+        if self.settings.getbool('DEDUP_NORMALIZE'):
+            url = dedup.normalize_url(url, self.settings.getlist(
+                'DEDUP_STRIP_PARAMS', dedup.TRACKING_PARAMS))
+
+        new = self.seen.add(url)
+        stats = self.crawler.stats
+        stats.inc_value('dedup/misses' if new else 'dedup/hits')
+        stats.set_value('dedup/memory_bytes', self.seen.memory)
+        return new
+
+    def in_shard(self, url):
+        """Whether `url' falls in this spider's shard of the URL space.
+
+        Spiders are split into `nshards' shards by their `shard' and
+        `nshards' arguments; without them every URL is in the shard.
+        """
+        nshards = int(getattr(self, 'nshards', 1))
+        if nshards <= 1:
+            return True
+        return zlib.crc32(url.lower().strip().encode('utf-8')) % nshards == \
+            int(getattr(self, 'shard', 0))
 
     def follow_once(self, response, url, *args, **kwargs):
         url = url.lower().strip()
-        if url not in self.visited:
-            self.visited.add(url)
+        if self.mark_visited(url):
             return response.follow(url, *args, **kwargs)
         return None
+
+    def closed(self, reason):
+        path = self.dedup_path()
+        if path and self._seen is not None:
+            dedup.save(self._seen, path)
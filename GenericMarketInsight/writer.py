@@ -0,0 +1,46 @@
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+
+class DatabaseWriter:
+    """Run database work on a dedicated thread, one call at a time.
+
+    At most `queue_depth' calls are queued on or running in the thread.
+    Further calls to `submit' wait for a free slot, and since the returned
+    Deferred fires only once the call is done, handing it back to Scrapy
+    holds items up until the writer catches up.
+    """
+
+    def __init__(self, queue_depth=4, name='DatabaseWriter'):
+        self.pool = ThreadPool(minthreads=1, maxthreads=1, name=name)
+        self.semaphore = defer.DeferredSemaphore(queue_depth)
+        self.pending = set()
+
+    def start(self):
+        self.pool.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Call `func' on the writer thread, returning a Deferred."""
+        # Imported here, as importing it installs the default reactor
+        # before Scrapy installs the one TWISTED_REACTOR asks for.
+        from twisted.internet import reactor
+
+        d = self.semaphore.run(
+            threads.deferToThreadPool, reactor, self.pool,
+            func, *args, **kwargs)
+        self.pending.add(d)
+        d.addBoth(self._done, d)
+        return d
+
+    def _done(self, result, d):
+        self.pending.discard(d)
+        return result
+
+    def drain(self):
+        """Return a Deferred firing once every submitted call is done."""
+        return defer.DeferredList(list(self.pending), consumeErrors=True)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        yield self.drain()
+        self.pool.stop()
@@ -0,0 +1,61 @@
+"""Compare the linear brand scan RyanscomputersSpider.match_brand used to do
+with the PrefixTrie lookup it does now."""
+import argparse
+import random
+import string
+import timeit
+
+from GenericMarketInsight.utils import PrefixTrie, remove_puncts
+
+
+def linear_match(brands, title):
+    for brand_filter in brands:
+        if remove_puncts(title.lower()).startswith(
+                remove_puncts(brand_filter.lower())):
+            return brand_filter
+    return None
+
+
+def make_dataset(nbrands, ntitles, seed=0):
+    rng = random.Random(seed)
+
+    def word(low, high):
+        return ''.join(rng.choice(string.ascii_letters)
+                       for _ in range(rng.randint(low, high)))
+
+    brands = {word(2, 10) for _ in range(nbrands)}
+    brands |= {brand + '-' + word(2, 5) for brand in rng.sample(
+        sorted(brands), len(brands) // 10)}
+    titles = [
+        '{} {} {}GB'.format(
+            rng.choice(sorted(brands)) if rng.random() < 0.9 else word(3, 8),
+            word(5, 30), rng.randint(1, 64))
+        for _ in range(ntitles)]
+    return brands, titles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--brands', type=int, default=400)
+    parser.add_argument('--titles', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    brands, titles = make_dataset(args.brands, args.titles)
+    trie = PrefixTrie(brands)
+
+    linear = min(timeit.repeat(
+        lambda: [linear_match(brands, title) for title in titles],
+        number=1, repeat=args.repeat))
+    indexed = min(timeit.repeat(
+        lambda: [trie.longest_prefix(title) for title in titles],
+        number=1, repeat=args.repeat))
+
+    print('{} brands, {} titles'.format(len(brands), len(titles)))
+    print('linear scan: {:9.1f} us/title'.format(linear / len(titles) * 1e6))
+    print('prefix trie: {:9.1f} us/title'.format(indexed / len(titles) * 1e6))
+    print('speedup:     {:9.1f}x'.format(linear / indexed))
+
+
+if __name__ == '__main__':
+    main()
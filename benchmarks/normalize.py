@@ -0,0 +1,117 @@
+"""Compare the price and status parsing the pipeline used to do, int() of
+the comma-stripped price and an if/elif chain over statuses, with the
+`PreProcessor' tables and price regex, one product at a time as the
+pipeline gets them.
+
+The old parsing is timed on well-formed products only, since it raises on
+the rest; the new one also on a dataset with decimals, currency signs and
+unparseable values.
+"""
+import argparse
+import random
+import timeit
+from urllib.parse import urlparse
+
+from GenericMarketInsight.pipelines import STATUSES, StarTechPreProcessor
+
+WELL_FORMED_STATUSES = ('{}৳', 'Out Of Stock', 'Pre Order', 'Up Coming',
+                        'Discontinued', 'Call for Price')
+MESSY_PRICES = ('{}.00', '৳ {}', 'Tk {}', '', 'TBA')
+MESSY_STATUSES = (' out of stock ', 'TBA', '')
+
+
+def old_parse(product):
+    """The old StarTechPreProcessor and Pipeline parsing."""
+    if product['status'].endswith('৳'):
+        product['status'] = 'Available'
+    product['code'] = product['id']
+    product['id'] = 'stech' + product['id']
+    product['price_regular'] = int(product['price_regular'].replace(',', ''))
+    product['price'] = int(product['price'].replace(',', ''))
+    product['url'] = urlparse(product['url']).path
+    status = product['status']
+    if status == 'Available':
+        status = STATUSES['Available']
+    elif status == "Out Of Stock":
+        status = STATUSES['Out Of Stock']
+    elif status == "Discontinued":
+        status = STATUSES['Discontinued']
+    elif status == "Pre Order":
+        status = STATUSES['Pre Order']
+    elif status == "Up Coming":
+        status = STATUSES['Up Coming']
+    elif status == "Call for Price":
+        status = STATUSES['Call for Price']
+    return product, status
+
+
+def make_dataset(nproducts, messy=0.0, seed=0):
+    rng = random.Random(seed)
+    products = []
+    for i in range(nproducts):
+        price = '{:,}'.format(rng.randrange(100, 500000))
+        price_format, status = '{}', rng.choice(WELL_FORMED_STATUSES)
+        if rng.random() < messy:
+            price_format = rng.choice(MESSY_PRICES)
+            status = rng.choice(MESSY_STATUSES + (status,))
+        products.append({
+            'id': str(i),
+            'price': price_format.format(price),
+            'price_regular': price,
+            'status': status.format(price),
+            'url': 'https://www.startech.com.bd/product-{}'.format(i),
+        })
+    return products
+
+
+def copies(products):
+    return [dict(product) for product in products]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--messy', type=float, default=0.1,
+                        help='share of malformed products in the messy set')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    well_formed = make_dataset(args.products)
+    messy = make_dataset(args.products, args.messy)
+
+    def best(func, dataset):
+        # Preprocessing modifies the products, so each run gets copies,
+        # made outside of the timed region.
+        return min(timeit.repeat(
+            'func(products)', setup='products = copies(dataset)',
+            number=1, repeat=args.repeat, globals={
+                'func': func, 'copies': copies, 'dataset': dataset}))
+
+    def preprocess(products):
+        preprocess_product = StarTechPreProcessor().preprocess_product
+        return [preprocess_product(product) for product in products]
+
+    old = best(lambda products: [old_parse(p) for p in products], well_formed)
+    new = best(preprocess, well_formed)
+    new_messy = best(preprocess, messy)
+
+    preprocessor = StarTechPreProcessor()
+    for product in copies(messy):
+        preprocessor.preprocess_product(product)
+
+    row = '{:<34} {:>10}'
+    print('{} products, {:.0%} malformed in the messy set'.format(
+        args.products, args.messy))
+    print(row.format('', 'us/product'))
+    for name, elapsed in (('if/elif and int()', old),
+                          ('preprocess_product', new),
+                          ('preprocess_product, messy', new_messy)):
+        print(row.format(name, '{:.2f}'.format(
+            elapsed / args.products * 1e6)))
+    print('Unparseable in the messy set: {}'.format(', '.join(
+        '{} {}'.format(count, field)
+        for field, count in sorted(preprocessor.unparseable.items()))))
+
+
+if __name__ == '__main__':
+    main()
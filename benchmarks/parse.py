@@ -0,0 +1,181 @@
+"""Replay fixture pages through the spiders' callbacks, without network.
+
+Every fixture is a page body, ``fixtures/<spider name>/<fixture>.html`` (or
+``.xml``), next to a ``<fixture>.json`` giving the ``callback`` to run, the
+page ``url`` and the callback's ``cb_kwargs``.
+
+The fixtures are synthetic: written by hand after the markup the spiders'
+selectors expect, with as many cards, rows and links as the sites' pages
+have, not saved from the sites. They time the parsing code, not how it
+copes with what the sites serve today. A page saved with curl or a
+browser, with its sidecar, can be added or swapped in the same way.
+
+Reports pages/sec, items/sec and the peak memory allocated while parsing
+one page, per fixture. ``--save`` stores the results as the JSON baseline,
+``--compare`` reports the change against it and fails on regressions.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from scrapy import Request
+from scrapy.http import HtmlResponse, XmlResponse
+from scrapy.utils.test import get_crawler
+
+from GenericMarketInsight.spiders.RyansComputers import RyanscomputersSpider
+from GenericMarketInsight.spiders.StarTech import StartechSpider
+
+SPIDERS = {spidercls.name: spidercls
+           for spidercls in (RyanscomputersSpider, StartechSpider)}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(HERE, 'fixtures')
+BASELINE = os.path.join(HERE, 'baselines', 'parse.json')
+
+
+class Fixture:
+    def __init__(self, spidercls, path):
+        self.spidercls = spidercls
+        self.name = '{}/{}'.format(
+            spidercls.name, os.path.splitext(os.path.basename(path))[0])
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            meta = json.load(f)
+        self.callback = meta['callback']
+        self.url = meta['url']
+        self.cb_kwargs = meta.get('cb_kwargs', {})
+        self.respcls = XmlResponse if path.endswith('.xml') else HtmlResponse
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.crawler = get_crawler(
+            spidercls, {'CRAWLSTATE_PATH': ':memory:',
+                        'GRID_UPDATES_ENABLED': True})
+
+    def prepare(self):
+        """Return a fresh spider's bound callback and a response for it."""
+        spider = self.spidercls.from_crawler(self.crawler)
+        # Spiders open their crawl state on first use, once per crawl.
+        getattr(spider, 'crawl_state', None)
+        callback = getattr(spider, self.callback)
+        request = Request(self.url, callback=callback,
+                          cb_kwargs=self.cb_kwargs)
+        response = self.respcls(
+            url=self.url, body=self.body, encoding='utf-8', request=request)
+        return callback, response
+
+    def run(self, callback, response):
+        """Parse the page, returning the number of items and requests."""
+        items = requests = 0
+        for output in callback(response, **self.cb_kwargs) or ():
+            if isinstance(output, Request):
+                requests += 1
+            elif output is not None:
+                items += 1
+        return items, requests
+
+
+def load_fixtures(directory=FIXTURES_DIR):
+    fixtures = []
+    for spider_name in sorted(os.listdir(directory)):
+        spidercls = SPIDERS.get(spider_name)
+        if spidercls is None:
+            continue
+        spider_dir = os.path.join(directory, spider_name)
+        for filename in sorted(os.listdir(spider_dir)):
+            if filename.endswith(('.html', '.xml')):
+                fixtures.append(Fixture(
+                    spidercls, os.path.join(spider_dir, filename)))
+    return fixtures
+
+
+def measure(fixture, min_time):
+    """Parse `fixture' repeatedly for at least `min_time' seconds."""
+    pages = items = requests = 0
+    elapsed = 0.0
+    while elapsed < min_time or not pages:
+        # Spiders remember what they followed, so every page gets a fresh
+        # spider, built outside of the timed region.
+        callback, response = fixture.prepare()
+        start = time.perf_counter()
+        page_items, page_requests = fixture.run(callback, response)
+        elapsed += time.perf_counter() - start
+        pages += 1
+        items += page_items
+        requests += page_requests
+
+    callback, response = fixture.prepare()
+    tracemalloc.start()
+    fixture.run(callback, response)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'pages_per_sec': pages / elapsed,
+        'items_per_sec': items / elapsed,
+        'items_per_page': items / pages,
+        'requests_per_page': requests / pages,
+        'peak_kib': peak / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='seconds to spend on every fixture')
+    parser.add_argument('--filter', default='',
+                        help='only run fixtures whose name contains this')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown ratio counted as a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    row = '{:<40} {:>10} {:>10} {:>9} {:>10} {:>8}'
+    print(row.format('fixture', 'pages/s', 'items/s', 'req/page',
+                     'peak KiB', 'change'))
+    for fixture in load_fixtures():
+        if args.filter not in fixture.name:
+            continue
+        result = results[fixture.name] = measure(fixture, args.min_time)
+
+        change = ''
+        if fixture.name in baseline:
+            ratio = result['pages_per_sec'] / \
+                baseline[fixture.name]['pages_per_sec']
+            change = '{:+.0%}'.format(ratio - 1)
+            if ratio < 1 - args.tolerance:
+                regressions.append(fixture.name)
+        print(row.format(
+            fixture.name,
+            '{:.1f}'.format(result['pages_per_sec']),
+            '{:.1f}'.format(result['items_per_sec']),
+            '{:.1f}'.format(result['requests_per_page']),
+            '{:.1f}'.format(result['peak_kib']),
+            change))
+
+    if args.save:
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
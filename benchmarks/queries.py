@@ -0,0 +1,170 @@
+"""Time insight queries on a synthetic database, without and with the
+indexes `migrations.create_indexes' adds to existing databases.
+
+The database is built once at ``--path`` and reused by later runs with the
+same number of products; building a million products takes a minute or
+two.
+"""
+import argparse
+import os
+import random
+import time
+
+from sqlalchemy import func, select
+
+import migrations
+import models
+
+CATEGORIES = 20
+SUBCATEGORIES = 10
+BRANDS = 500
+SPEC_KEYS = 30
+SPECS_PER_PRODUCT = 3
+SPEC_VALUES = 50
+CHUNK_SIZE = 50000
+
+
+def build(engine, nproducts, seed=0):
+    rng = random.Random(seed)
+    products = models.Product.__table__
+    specs = models.Specification.__table__
+    with engine.begin() as conn:
+        conn.execute(models.Platform.__table__.insert(), [
+            {'id': 1, 'title': 'Star Tech', 'url': 'www.startech.com.bd'},
+            {'id': 2, 'title': 'Ryans Computers', 'url': 'ryanscomputers.com'},
+        ])
+        conn.execute(models.Brand.__table__.insert(), [
+            {'id': i, 'title': 'brand{}'.format(i)} for i in range(BRANDS)])
+        conn.execute(models.SpecKey.__table__.insert(), [
+            {'id': i, 'key': 'key{}'.format(i)} for i in range(SPEC_KEYS)])
+
+    for start in range(0, nproducts, CHUNK_SIZE):
+        rows, spec_rows, review_rows = [], [], []
+        for i in range(start, min(start + CHUNK_SIZE, nproducts)):
+            product_id = 'p{}'.format(i)
+            rows.append({
+                'id': product_id,
+                'title': 'Product {}'.format(i),
+                'category': 'c{}'.format(rng.randrange(CATEGORIES)),
+                'subcategory1': 's{}'.format(rng.randrange(SUBCATEGORIES)),
+                'subcategory2': 's{}'.format(rng.randrange(SUBCATEGORIES)),
+                'price_regular': rng.randrange(1000, 200000),
+                'price': rng.randrange(1000, 200000),
+                'code': product_id,
+                'url': '/product/{}'.format(i),
+                'status': models.ItemStatusEnum.AVAILABLE,
+                'brand_id': rng.randrange(BRANDS),
+                'platform_id': rng.randint(1, 2),
+            })
+            spec_rows.extend({
+                'product_id': product_id,
+                'key_id': key_id,
+                'value': 'v{}'.format(rng.randrange(SPEC_VALUES)),
+            } for key_id in rng.sample(range(SPEC_KEYS), SPECS_PER_PRODUCT))
+            if rng.random() < 0.1:
+                review_rows.append({
+                    'product_id': product_id, 'rating': rng.randint(1, 5),
+                    'username': 'user{}'.format(i), 'comment': 'Fine.'})
+        with engine.begin() as conn:
+            conn.execute(products.insert(), rows)
+            conn.execute(specs.insert(), spec_rows)
+            if review_rows:
+                conn.execute(models.Review.__table__.insert(), review_rows)
+
+
+def drop_indexes(engine):
+    """Drop the indexes older databases lack, keeping the unique keys."""
+    with engine.begin() as conn:
+        for table in (models.Product.__table__,
+                      models.Specification.__table__):
+            for index in table.indexes:
+                if not index.unique and index.name != 'ix_products_code':
+                    index.drop(conn, checkfirst=True)
+
+
+def make_queries(rng, nproducts):
+    products = models.Product.__table__
+    specs = models.Specification.__table__
+    reviews = models.Review.__table__
+
+    def product_id():
+        return 'p{}'.format(rng.randrange(nproducts))
+
+    return {
+        'products of a subcategory': lambda: select(func.count()).where(
+            products.c.category == 'c{}'.format(rng.randrange(CATEGORIES)),
+            products.c.subcategory1 == 's{}'.format(
+                rng.randrange(SUBCATEGORIES))),
+        'products of a brand': lambda: select(
+            products.c.id, products.c.price).where(
+                products.c.brand_id == rng.randrange(BRANDS)),
+        'products by spec value': lambda: select(specs.c.product_id).where(
+            specs.c.key_id == rng.randrange(SPEC_KEYS),
+            specs.c.value == 'v{}'.format(rng.randrange(SPEC_VALUES))),
+        'specs of a product': lambda: select(
+            specs.c.key_id, specs.c.value).where(
+                specs.c.product_id == product_id()),
+        'reviews of a product': lambda: select(reviews).where(
+            reviews.c.product_id == product_id()),
+    }
+
+
+def measure(engine, queries, repeat):
+    """Return the mean seconds per run of every query."""
+    results = {}
+    with engine.connect() as conn:
+        for name, query in queries.items():
+            elapsed = 0.0
+            for _ in range(repeat):
+                statement = query()
+                start = time.perf_counter()
+                conn.execute(statement).fetchall()
+                elapsed += time.perf_counter() - start
+            results[name] = elapsed / repeat
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=1000000)
+    parser.add_argument('--path', default=os.path.join(
+        'datadir', 'benchmark-queries.sqlite3'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    path = '{}.{}'.format(args.path, args.products)
+    dburi = 'sqlite:///' + path
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        start = time.perf_counter()
+        build(models.create_db_engine(dburi), args.products)
+        print('Built {} products in {:.1f} seconds'.format(
+            args.products, time.perf_counter() - start))
+
+    engine = models.create_db_engine(dburi)
+    drop_indexes(engine)
+    before = measure(
+        engine, make_queries(random.Random(1), args.products), args.repeat)
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        migrations.create_indexes(conn)
+    indexing = time.perf_counter() - start
+    after = measure(
+        engine, make_queries(random.Random(1), args.products), args.repeat)
+
+    row = '{:<26} {:>12} {:>12} {:>9}'
+    print(row.format('query', 'no index ms', 'indexed ms', 'speedup'))
+    for name in before:
+        print(row.format(
+            name,
+            '{:.2f}'.format(before[name] * 1e3),
+            '{:.2f}'.format(after[name] * 1e3),
+            '{:.0f}x'.format(before[name] / after[name])))
+    print('Creating the indexes took {:.1f} seconds'.format(indexing))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Versioned, in place upgrades of existing databases.
+
+The version of a database is kept in its ``schema_version`` table. New
+databases get the current schema from `models' and are stamped with the
+latest version. Older ones run every migration above their version, in
+order. Databases created before versioning count as version 0.
+
+A migration is a function taking a connection, appended to `MIGRATIONS'
+whenever `models' changes a table that already exists. Tables new to
+`models' are created by ``create_all`` and need none.
+"""
+import logging
+import threading
+
+from sqlalchemy import Column, Integer, MetaData, Table, func, inspect, \
+    select, text
+
+import models
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, nullable=False),
+)
+
+# Spiders of one process open the same database side by side.
+lock = threading.Lock()
+
+
+def add_columns(conn, table, names):
+    """Add the `names' columns of `table' the database lacks."""
+    columns = {column['name'] for column in inspect(conn).get_columns(
+        table.name)}
+    for name in names:
+        if name not in columns:
+            column = table.c[name]
+            conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, name, column.type.compile(conn.dialect))))
+
+
+def add_product_hashes(conn):
+    """Add the columns telling which stored products changed."""
+    add_columns(conn, models.Product.__table__, ('content_hash', 'specs_hash'))
+
+
+def merge_duplicates(conn, table, key, references=()):
+    """Keep the first of the `table' rows whose `key' columns are equal,
+    pointing the `references' (table, column) pairs to it.
+
+    `key' are SQL expressions, with ``{}`` standing for the table.
+    """
+    first = 'SELECT MIN(d.id) FROM {} d GROUP BY {}'.format(
+        table, ', '.join(column.format('d') for column in key))
+    same = ' AND '.join(
+        '{} = {}'.format(column.format('a'), column.format('b'))
+        for column in key)
+    for referencing, column in references:
+        conn.execute(text(
+            'UPDATE {referencing} SET {column} = ('
+            'SELECT MIN(b.id) FROM {table} a JOIN {table} b ON {same} '
+            'WHERE a.id = {referencing}.{column}) '
+            'WHERE {column} NOT IN ({first})'.format(
+                referencing=referencing, column=column, table=table,
+                same=same, first=first)))
+    conn.execute(text('DELETE FROM {} WHERE id NOT IN ({})'.format(
+        table, first)))
+
+
+def add_collection_keys(conn):
+    """Add the unique keys reviews and questions are inserted by, merging
+    the duplicate rows older crawls wrote."""
+    merge_duplicates(
+        conn, 'reviews', ('{}.product_id', '{}.username', '{}.comment'))
+    merge_duplicates(
+        conn, 'questions', ('{}.product_id', '{}.username', '{}.question'))
+
+    statements = (
+        'CREATE UNIQUE INDEX IF NOT EXISTS '
+        'ux_reviews_product_username_comment '
+        'ON reviews (product_id, username, comment)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS '
+        'ux_questions_product_username_question '
+        'ON questions (product_id, username, question)',
+    )
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+def add_platform_brand_keys(conn):
+    """Add the unique keys platforms and brands are got or created by,
+    merging the duplicate rows older crawls wrote."""
+    merge_duplicates(
+        conn, 'platforms', ('{}.title', '{}.url'),
+        [('products', 'platform_id')])
+    merge_duplicates(
+        conn, 'brands', ('lower({}.title)',), [('products', 'brand_id')])
+
+    statements = (
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_platforms_title_url '
+        'ON platforms (title, url)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_brands_title_lower '
+        'ON brands (lower(title))',
+    )
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+def add_product_specs(conn):
+    """Add the column holding every specification of a product."""
+    add_columns(conn, models.Product.__table__, ('specs',))
+
+
+def intern_spec_keys(conn):
+    """Point every specification row to the spec_keys id of its key.
+
+    The old key column is left in place, unused, as SQLite drops columns
+    only from 3.35 on.
+    """
+    columns = {column['name'] for column in inspect(conn).get_columns(
+        'specs')}
+    if 'key' not in columns or 'key_id' in columns:
+        return
+
+    conn.execute(text(
+        'INSERT INTO spec_keys (key) SELECT DISTINCT key FROM specs '
+        'WHERE key IS NOT NULL AND key NOT IN (SELECT key FROM spec_keys)'))
+    conn.execute(text(
+        'ALTER TABLE specs ADD COLUMN key_id INTEGER '
+        'REFERENCES spec_keys (id)'))
+    conn.execute(text(
+        'UPDATE specs SET key_id = ('
+        'SELECT id FROM spec_keys WHERE spec_keys.key = specs.key)'))
+    conn.execute(text('DELETE FROM specs WHERE key_id IS NULL'))
+
+
+def create_indexes(conn):
+    """Create the indexes `models' declares but the database lacks.
+
+    Indexes over expressions cannot be reflected, so they are created by
+    their own migration.
+    """
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if all(isinstance(expression, Column)
+                   for expression in index.expressions):
+                index.create(conn, checkfirst=True)
+
+
+def rename_ryans_platform(conn):
+    """Fix the title Ryans Computers' platform was stored with."""
+    conn.execute(text(
+        "UPDATE platforms SET title = 'Ryans Computers' "
+        "WHERE title = 'Star Tech' "
+        "AND url IN ('ryanscomputers.com', 'www.ryanscomputers.com')"))
+
+
+MIGRATIONS = (
+    add_product_hashes,
+    add_collection_keys,
+    add_platform_brand_keys,
+    add_product_specs,
+    intern_spec_keys,
+    create_indexes,
+    # ix_products_brand_id, ix_products_platform_id, ix_products_category.
+    create_indexes,
+    rename_ryans_platform,
+    # ix_products_platform_url.
+    create_indexes,
+)
+
+
+def get_version(conn):
+    if not inspect(conn).has_table(schema_version.name):
+        schema_version.create(conn)
+        conn.execute(schema_version.insert().values(version=0))
+        return 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar()
+
+
+def upgrade(engine):
+    """Create the tables of `models', then bring older ones up to date.
+
+    Returns the version the database was at.
+    """
+    with lock, engine.begin() as conn:
+        fresh = not inspect(conn).has_table(models.Product.__tablename__)
+        models.Base.metadata.create_all(conn)
+        version = get_version(conn)
+        if fresh:
+            version = len(MIGRATIONS)
+        for number, migration in enumerate(
+                MIGRATIONS[version:], start=version + 1):
+            logger.info("Migrating %s to version %d: %s",
+                        engine.url, number, migration.__name__)
+            migration(conn)
+        conn.execute(schema_version.update().values(version=len(MIGRATIONS)))
+        return version
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import threading
 from enum import IntEnum
 
-from sqlalchemy import Column, Enum, ForeignKey, Integer, String, create_engine
+from sqlalchemy import JSON, Column, Enum, ForeignKey, Index, Integer, \
+    String, UniqueConstraint, create_engine, event, func, select
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import aliased, relationship, sessionmaker
 
 Base = declarative_base()
 
@@ -20,17 +23,26 @@ class ItemStatusEnum(IntEnum):
 
 class Platform(Base):
     __tablename__ = "platforms"
+    __table_args__ = (UniqueConstraint("title", "url"),)
 
     id = Column(Integer, primary_key=True)
     url = Column(String)
     title = Column(String)
 
     products = relationship("Product", back_populates="platform")
+    crawls = relationship("Crawl", back_populates="platform")
 
 
 # TODO: Add product views field.
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (
+        # Insight queries filter by category, then subcategories.
+        Index("ix_products_category", "category", "subcategory1",
+              "subcategory2"),
+        # Grid updates find products by platform and URL.
+        Index("ix_products_platform_url", "platform_id", "url"),
+    )
 
     id = Column(String, primary_key=True)
     title = Column(String)
@@ -42,15 +54,24 @@ class Product(Base):
     code = Column(String, index=True)
     url = Column(String)
     status = Column(Enum(ItemStatusEnum))
+    # Digests of the scraped columns and of the specifications, used to skip
+    # rewriting products that did not change since the last crawl.
+    content_hash = Column(String(32))
+    specs_hash = Column(String(32))
+    # Every specification as a {key: value} object, read in one go. Only
+    # written with ``PIPELINE_SPECS_JSON``.
+    specs = Column(JSON(none_as_null=True))
 
     reviews = relationship("Review", back_populates="product")
     specifications = relationship("Specification", back_populates="product")
     questions = relationship("Question", back_populates="product")
+    observations = relationship("PriceObservation", back_populates="product")
 
-    brand_id = Column(Integer, ForeignKey("brands.id"))
+    brand_id = Column(Integer, ForeignKey("brands.id"), index=True)
     brand = relationship("Brand", back_populates="products")
 
-    platform_id = Column(Integer, ForeignKey("platforms.id"), nullable=False)
+    platform_id = Column(
+        Integer, ForeignKey("platforms.id"), nullable=False, index=True)
     platform = relationship("Platform", back_populates="products")
 
 
@@ -63,8 +84,14 @@ class Brand(Base):
     products = relationship("Product", back_populates="brand")
 
 
+# Brands are matched case-insensitively.
+Index("ux_brands_title_lower", func.lower(Brand.title), unique=True)
+
+
 class Review(Base):
     __tablename__ = "reviews"
+    # The unique key doubles as the index of reviews by product.
+    __table_args__ = (UniqueConstraint("product_id", "username", "comment"),)
 
     id = Column(Integer, primary_key=True)
     rating = Column(Integer)
@@ -75,19 +102,38 @@ class Review(Base):
     product = relationship("Product", back_populates="reviews")
 
 
+class SpecKey(Base):
+    """A specification key, stored once and referred to by id."""
+    __tablename__ = "spec_keys"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True, nullable=False)
+
+    specifications = relationship("Specification", back_populates="key")
+
+
 class Specification(Base):
     __tablename__ = "specs"
+    __table_args__ = (
+        # Products by specification value, e.g. RAM = 16GB.
+        Index("ix_specs_key_value", "key_id", "value"),
+        Index("ix_specs_product_id", "product_id"),
+    )
 
     id = Column(Integer, primary_key=True)
-    key = Column(String)
     value = Column(String)
 
+    key_id = Column(Integer, ForeignKey("spec_keys.id"), nullable=False)
+    key = relationship("SpecKey", back_populates="specifications")
+
     product_id = Column(String, ForeignKey("products.id"))
     product = relationship("Product", back_populates="specifications")
 
 
 class Question(Base):
     __tablename__ = "questions"
+    # The unique key doubles as the index of questions by product.
+    __table_args__ = (UniqueConstraint("product_id", "username", "question"),)
 
     id = Column(Integer, primary_key=True)
     username = Column(String)
@@ -98,12 +144,206 @@ class Question(Base):
     product = relationship("Product", back_populates="questions")
 
 
+class Crawl(Base):
+    __tablename__ = "crawls"
+
+    id = Column(Integer, primary_key=True)
+    spider = Column(String)
+    # Unix timestamps, in seconds.
+    started_at = Column(Integer)
+    finished_at = Column(Integer)
+
+    platform_id = Column(Integer, ForeignKey("platforms.id"), nullable=False)
+    platform = relationship("Platform", back_populates="crawls")
+
+    observations = relationship("PriceObservation", back_populates="crawl")
+
+
+class PriceObservation(Base):
+    """A product's price and status, recorded only when either changes."""
+    __tablename__ = "price_observations"
+    __table_args__ = (
+        Index("ix_price_observations_product_timestamp",
+              "product_id", "timestamp"),
+        Index("ix_price_observations_crawl_product", "crawl_id", "product_id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # Unix timestamp, in seconds.
+    timestamp = Column(Integer, nullable=False)
+    price_regular = Column(Integer)
+    price = Column(Integer)
+    status = Column(Enum(ItemStatusEnum))
+
+    product_id = Column(String, ForeignKey("products.id"), nullable=False)
+    product = relationship("Product", back_populates="observations")
+
+    crawl_id = Column(Integer, ForeignKey("crawls.id"), nullable=False)
+    crawl = relationship("Crawl", back_populates="observations")
+
+
+def price_series(product_id):
+    """Select a product's observations in chronological order."""
+    return select(PriceObservation). \
+        where(PriceObservation.product_id == product_id). \
+        order_by(PriceObservation.timestamp)
+
+
+def price_drops(crawl_id=None, platform_id=None):
+    """Select the products whose price dropped in a crawl.
+
+    Defaults to the latest crawl of every platform, or of the platform of
+    `platform_id'. Each observation of the crawls is compared with the
+    product's previous observation, which is looked up through the
+    (product_id, timestamp) index.
+    """
+    if crawl_id is None:
+        latest = select(func.max(Crawl.id)).group_by(Crawl.platform_id)
+        if platform_id is not None:
+            latest = latest.where(Crawl.platform_id == platform_id)
+        crawl_ids = latest
+    else:
+        crawl_ids = [crawl_id]
+
+    previous = aliased(PriceObservation)
+    price_previous = select(previous.price). \
+        where(previous.product_id == PriceObservation.product_id). \
+        where(previous.timestamp <= PriceObservation.timestamp). \
+        where(previous.id < PriceObservation.id). \
+        order_by(previous.timestamp.desc(), previous.id.desc()). \
+        limit(1).scalar_subquery()
+
+    return select(
+        PriceObservation.product_id,
+        price_previous.label('price_previous'),
+        PriceObservation.price,
+        PriceObservation.timestamp,
+    ).where(PriceObservation.crawl_id.in_(crawl_ids)). \
+        where(PriceObservation.price < price_previous)
+
+
 DEFAULT_DBURI = 'sqlite:///datadir/db.sqlite3'
 
 
+def insert(bind, table):
+    """Return an INSERT for `table' that supports ON CONFLICT clauses."""
+    if bind.dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    if bind.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    raise NotImplementedError(
+        "Upserts are not supported on {}".format(bind.dialect.name))
+
+
+def get_or_create(engine, table, **values):
+    """Return the id of the `table' row matching `values', inserting it if
+    missing. Relies on a unique constraint over the columns of `values'."""
+    with engine.begin() as conn:
+        conn.execute(insert(conn, table).on_conflict_do_nothing(), values)
+        query = select(table.c.id)
+        for column, value in values.items():
+            query = query.where(table.c[column] == value)
+        return conn.execute(query).scalar()
+
+
+class NameRegistry:
+    """Process-wide cache of the ids of the names in a table, shared by
+    every pipeline writing to the same database.
+
+    Names are created on first use; a unique index on `column' settles
+    races with other processes.
+    """
+    registries = {}
+    registries_lock = threading.Lock()
+
+    table = None
+    column = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = None
+
+    @classmethod
+    def for_engine(cls, engine):
+        with cls.registries_lock:
+            return cls.registries.setdefault((cls, str(engine.url)), cls())
+
+    def normalize(self, name):
+        """Return the form `name' is matched by."""
+        return name
+
+    def normalized(self, column):
+        """Return `column' in the form names are matched by, in SQL."""
+        return column
+
+    def resolve(self, engine, names):
+        """Map each name in `names' to its id."""
+        column = self.table.c[self.column]
+        with self.lock:
+            if self.ids is None:
+                with engine.connect() as conn:
+                    self.ids = {
+                        self.normalize(name): name_id for name_id, name in
+                        conn.execute(select(self.table.c.id, column))}
+
+            missing = {
+                self.normalize(name): name for name in names
+                if name and self.normalize(name) not in self.ids}
+            if missing:
+                with engine.begin() as conn:
+                    conn.execute(
+                        insert(conn, self.table).on_conflict_do_nothing(),
+                        [{self.column: name} for name in missing.values()])
+                    self.ids.update(
+                        (self.normalize(name), name_id) for name_id, name in
+                        conn.execute(select(self.table.c.id, column).where(
+                            self.normalized(column).in_(list(missing)))))
+
+            return {name: self.ids[self.normalize(name)]
+                    for name in names if name}
+
+
+class BrandRegistry(NameRegistry):
+    """Brand ids, brands being matched case-insensitively."""
+    table = Brand.__table__
+    column = 'title'
+
+    def normalize(self, name):
+        return name.lower()
+
+    def normalized(self, column):
+        return func.lower(column)
+
+
+class SpecKeyRegistry(NameRegistry):
+    """Specification key ids."""
+    table = SpecKey.__table__
+    column = 'key'
+
+
+def create_db_engine(dburi, echo=False):
+    if dburi.startswith('sqlite'):
+        # Wait on locks held by concurrent writers instead of failing.
+        engine = create_engine(
+            dburi, echo=echo, connect_args={'timeout': 60})
+        event.listen(engine, 'connect', enable_wal)
+    else:
+        engine = create_engine(dburi, echo=echo)
+
+    from migrations import upgrade
+    upgrade(engine)
+    return engine
+
+
+def enable_wal(dbapi_connection, _):
+    """Let readers and a writer from other processes work concurrently."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
 def create_db_session(dburi, echo=False):
-    engine = create_engine(dburi, echo=echo)
-    Base.metadata.create_all(engine)
+    engine = create_db_engine(dburi, echo=echo)
     Session = sessionmaker(bind=engine)
     session = Session()
     return session
@@ -1,18 +1,178 @@
-from scrapy.crawler import CrawlerProcess
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+
+from scrapy.crawler import Crawler, CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
+import models
+from GenericMarketInsight.merge import merge_database
+from GenericMarketInsight.profiler import SamplingProfiler
 from GenericMarketInsight.spiders.RyansComputers import RyanscomputersSpider
 from GenericMarketInsight.spiders.StarTech import StartechSpider
 
+SPIDERS = [RyanscomputersSpider, StartechSpider]
+
+STAGING_DIR = os.path.join('datadir', 'staging')
 
-def run():
+
+def spider_settings(spidercls, shard=0):
+    """Return the project settings, with JOBDIR set to the shard's own
+    directory under JOBS_DIR."""
+    settings = get_project_settings()
+    if settings.get('JOBS_DIR'):
+        settings.set('JOBDIR', os.path.join(
+            settings['JOBS_DIR'], '{}-{}'.format(spidercls.name, shard)))
+    return settings
+
+
+def create_crawler(spidercls, settings):
+    """Return a crawler of `spidercls' with its own `settings'."""
+    try:
+        # Later Scrapy versions install the TWISTED_REACTOR only for
+        # crawlers asking for it, as the first one to start does.
+        return Crawler(spidercls, settings, init_reactor=True)
+    except TypeError:
+        return Crawler(spidercls, settings)
+
+
+def start_profiled(process, profile=None, interval=0.01):
+    """Start `process', sampling where its CPU time goes into
+    ``<profile>.collapsed`` when `profile' is given."""
+    if not profile:
+        process.start()
+        return
+
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        process.start()
+    finally:
+        profiler.stop()
+    profiler.write_collapsed(profile + '.collapsed')
+    print(profiler.format_table())
+    print('Wrote the collapsed stacks to {}.collapsed'.format(profile))
+
+
+def run(profile=None, profile_interval=0.01):
     settings = get_project_settings()
     crawler = CrawlerProcess(settings)
-    crawler.crawl(RyanscomputersSpider)
-    crawler.crawl(StartechSpider)
-    crawler.start()
+    for spidercls in SPIDERS:
+        crawler.crawl(create_crawler(spidercls, spider_settings(spidercls)))
+    start_profiled(crawler, profile, profile_interval)
     crawler.join()
 
 
+def run_worker(job):
+    """Crawl one shard of a spider into its own staging database."""
+    spidercls_name, shard, nshards, profile, profile_interval = job
+    spidercls = next(s for s in SPIDERS if s.__name__ == spidercls_name)
+
+    path = os.path.join(STAGING_DIR, '{}-{}.sqlite3'.format(
+        spidercls.name, shard))
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    settings = spider_settings(spidercls, shard)
+    # The staging database starts empty, so the shard's queue does too
+    # rather than resuming requests whose items it no longer holds.
+    if settings.get('JOBDIR'):
+        shutil.rmtree(settings['JOBDIR'], ignore_errors=True)
+    # Grid updates apply to products already stored, and a staging database
+    # starts empty, so workers fetch every product page instead.
+    settings.set('GRID_UPDATES_ENABLED', False)
+    process = CrawlerProcess(get_project_settings())
+    crawler = create_crawler(spidercls, settings)
+    process.crawl(
+        crawler, dburi='sqlite:///' + path, shard=shard, nshards=nshards)
+    start = time.monotonic()
+    start_profiled(
+        process,
+        profile and '{}-{}-{}'.format(profile, spidercls.name, shard),
+        profile_interval)
+    elapsed = time.monotonic() - start
+
+    stats = crawler.stats.get_stats()
+    return {
+        'spider': spidercls.name,
+        'shard': shard,
+        'nshards': nshards,
+        'dburi': 'sqlite:///' + path,
+        'elapsed': elapsed,
+        'pages': stats.get('response_received_count', 0),
+        'items': stats.get('item_scraped_count', 0),
+    }
+
+
+def run_workers(workers, dburi=models.DEFAULT_DBURI, profile=None,
+                profile_interval=0.01):
+    """Crawl every spider over `workers' processes, then merge the results.
+
+    With more workers than spiders, each spider's URL space is split into
+    shards, one per worker, the first spiders getting one more when the
+    workers do not split evenly. Every worker writes its own profile.
+    """
+    jobs = []
+    for i, spidercls in enumerate(SPIDERS):
+        nshards = max(1, workers // len(SPIDERS) + (
+            i < workers % len(SPIDERS)))
+        jobs.extend(
+            (spidercls.__name__, shard, nshards, profile, profile_interval)
+            for shard in range(nshards))
+
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    # A Twisted reactor cannot be restarted, so every job gets a fresh
+    # process.
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, maxtasksperchild=1) as pool:
+        results = list(pool.imap_unordered(run_worker, jobs))
+
+    start = time.monotonic()
+    for result in results:
+        merge_database(result['dburi'], dburi)
+    merge_elapsed = time.monotonic() - start
+
+    print_summary(results, merge_elapsed)
+
+
+def print_summary(results, merge_elapsed):
+    row = '{:<16} {:>7} {:>9} {:>9} {:>9} {:>9}'
+    print(row.format('spider', 'shard', 'pages', 'items', 'seconds',
+                     'items/s'))
+    for result in sorted(results, key=lambda r: (r['spider'], r['shard'])):
+        print(row.format(
+            result['spider'],
+            '{}/{}'.format(result['shard'] + 1, result['nshards']),
+            result['pages'],
+            result['items'],
+            '{:.1f}'.format(result['elapsed']),
+            '{:.2f}'.format(result['items'] / result['elapsed']
+                            if result['elapsed'] else 0)))
+    print('Merged {} staging databases in {:.1f} seconds'.format(
+        len(results), merge_elapsed))
+
+
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='crawl in this many processes, merging their staging '
+             'databases into the main one at the end')
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='sample the CPU time of the crawl, writing collapsed stacks '
+             'to PATH.collapsed and printing the time spent per module')
+    parser.add_argument(
+        '--profile-interval', type=float, default=10, metavar='MS',
+        help='CPU milliseconds between profile samples')
+    args = parser.parse_args()
+
+    interval = args.profile_interval / 1e3
+    if args.workers > 0:
+        run_workers(args.workers, profile=args.profile,
+                    profile_interval=interval)
+    else:
+        run(args.profile, interval)